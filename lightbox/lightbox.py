@@ -13,12 +13,14 @@ authoring interface.
 
 from __future__ import annotations
 
+import functools
 import hashlib
+import operator
 import os
 import posixpath
 import re
 import shutil
-from html import escape as html_escape
+from collections.abc import Callable
 from pathlib import Path
 from typing import Any, cast
 
@@ -29,6 +31,7 @@ from sphinx.locale import get_translation
 from sphinx.transforms.post_transforms import SphinxPostTransform
 from sphinx.util import logging
 from sphinx.util.docutils import SphinxDirective
+from sphinx.util.images import get_image_size
 from sphinx.util.texescape import escape as latex_escape
 
 logger = logging.getLogger(__name__)
@@ -66,10 +69,27 @@ _POLICIES = {"explicit", "all", "none"}
 _GALLERY_MODES = {"document", "none"}
 _LIGHTBOX_ENV_VERSION = 2
 _SAFE_ID_PART_RE = re.compile(r"[^A-Za-z0-9_.:-]+")
-_URI_SCHEME_RE = re.compile(r"^[a-z][a-z0-9+.-]*:")
+# Protocol-relative ("//host") or scheme-prefixed ("https:", "data:") URIs,
+# matched case-insensitively after optional leading whitespace.
+_REMOTE_URI_RE = re.compile(r"\s*(?://|[a-z][a-z0-9+.-]*:)", re.IGNORECASE)
+# Path segments that posixpath.normpath() would collapse: empty, "." and "..".
+_NON_NORMAL_SEGMENT_RE = re.compile(r"(?:^|/)\.{0,2}(?:/|$)")
 _SAFE_CSS_WIDTH_RE = re.compile(r"^(?:auto|0|[0-9]+(?:\.[0-9]+)?(?:%|px|em|rem|vw|vh|vmin|vmax)?)$")
 _SAFE_STYLE_CHARS_RE = re.compile(r"^[0-9A-Za-z\s.:;,%()+*/-]+$")
 _UNSAFE_CSS_TOKENS = ("url(", "expression(", "@import", "\\")
+# Same replacements as ``html.escape(value, quote=True)``, applied in one C-level
+# ``str.translate`` pass instead of five chained ``str.replace`` calls.
+_HTML_ATTR_TABLE = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"}
+)
+# Most values contain none of those characters; a C-level search is cheaper
+# than a translate pass that would rebuild the string unchanged.
+_HTML_SPECIALS_RE = re.compile(r"[&<>\"']")
+# Source-relative URIs always use "/"; only Windows needs them rewritten before
+# joining onto srcdir, so POSIX binds a no-op instead of scanning every path.
+_to_native: Callable[[str], str] = (
+    str if os.sep == "/" else operator.methodcaller("replace", "/", os.sep)
+)
 
 
 # ---------------------------------------------------------------------------
@@ -94,8 +114,7 @@ def _visit_skip(self: Any, node: nodes.Node) -> None:
 
 def _is_remote_or_data_uri(uri: str) -> bool:
     """Return whether an image URI should stay outside lightbox processing."""
-    normalized = uri.strip().lower()
-    return normalized.startswith("//") or _URI_SCHEME_RE.match(normalized) is not None
+    return _REMOTE_URI_RE.match(uri) is not None
 
 
 def _is_lightbox_html_builder(builder: Any) -> bool:
@@ -105,6 +124,15 @@ def _is_lightbox_html_builder(builder: Any) -> bool:
     return getattr(builder, "format", "") == "html" and getattr(builder, "name", "") != "epub"
 
 
+def _esc_attr(value: str) -> str:
+    """Escape text for HTML content and double-quoted attribute values."""
+    # Lazy translations such as _("Image") are proxies, which re.search rejects.
+    value = str(value)
+    if _HTML_SPECIALS_RE.search(value) is None:
+        return value
+    return value.translate(_HTML_ATTR_TABLE)
+
+
 def _safe_html_id_part(value: str, fallback: str = "document") -> str:
     """Return a conservative string for generated HTML id fragments."""
     safe_value = _SAFE_ID_PART_RE.sub("-", value).strip("-")
@@ -121,16 +149,21 @@ def _accessible_image_name(alt_text: str, uri: str) -> str:
     return re.sub(r"[-_]+", " ", stem).strip() or _("Image")
 
 
+@functools.lru_cache(maxsize=8)
+def _real_srcdir(srcdir: str) -> str:
+    """Return srcdir as the absolute, symlink-free path used for containment checks."""
+    # realpath() already makes its result absolute, so no abspath() is needed.
+    return os.path.realpath(srcdir)
+
+
 def _source_image_path(srcdir: str, uri: str) -> str | None:
     """Resolve an image URI to an absolute source path confined to srcdir."""
     if not srcdir or _is_remote_or_data_uri(uri):
         return None
 
     rel_uri = uri.lstrip("/")
-    image_path = os.path.realpath(
-        os.path.abspath(os.path.join(srcdir, rel_uri.replace("/", os.sep)))
-    )
-    safe_srcdir = os.path.realpath(os.path.abspath(srcdir))
+    image_path = os.path.realpath(os.path.join(srcdir, _to_native(rel_uri)))
+    safe_srcdir = _real_srcdir(srcdir)
     try:
         if os.path.commonpath([safe_srcdir, image_path]) != safe_srcdir:
             return None
@@ -139,6 +172,77 @@ def _source_image_path(srcdir: str, uri: str) -> str | None:
     return image_path
 
 
+@functools.lru_cache(maxsize=1024)
+def _cached_image_size(abs_fs_path: str, mtime: float) -> tuple[int, int] | None:
+    """Return image dimensions, memoized per source path and modification time."""
+    return cast(tuple[int, int] | None, get_image_size(abs_fs_path))
+
+
+def _image_size(abs_fs_path: str) -> tuple[int, int] | None:
+    """Return image dimensions, bypassing the cache for files that cannot be stat'ed."""
+    try:
+        mtime = os.path.getmtime(abs_fs_path)
+    except OSError:
+        return _cached_image_size.__wrapped__(abs_fs_path, 0.0)
+    # Keying on mtime keeps incremental rebuilds correct when an image changes
+    # while a long-lived builder process still holds the cached dimensions.
+    return _cached_image_size(abs_fs_path, mtime)
+
+
+@functools.lru_cache(maxsize=4096)
+def _resolve_cached(srcdir: str, docname_dir: str, raw_path: str) -> tuple[str, str] | None:
+    """Resolve a directive image path to ``(source-relative path, absolute path)``.
+
+    Returns ``None`` when the target escapes srcdir. Only path arithmetic is
+    memoized: the caller checks existence on every call, so images generated
+    into srcdir during the build are found. Warnings stay with the caller
+    because logging side effects cannot be memoized.
+    """
+    if raw_path.startswith("/"):
+        rel_to_source = raw_path.lstrip("/")
+    elif _NON_NORMAL_SEGMENT_RE.search(raw_path):
+        rel_to_source = posixpath.normpath(posixpath.join(docname_dir, raw_path))
+    else:
+        # Already normal: no empty, "." or ".." segments for normpath to fold.
+        rel_to_source = f"{docname_dir}/{raw_path}" if docname_dir else raw_path
+
+    # Resolve symlinks as well as ``..`` components before checking the
+    # boundary; otherwise a path inside srcdir can point to an outside file.
+    abs_fs_path = os.path.realpath(os.path.join(srcdir, _to_native(rel_to_source)))
+    safe_srcdir = _real_srcdir(srcdir)
+
+    # Compare the common path to ensure the target is strictly inside srcdir
+    try:
+        if os.path.commonpath([safe_srcdir, abs_fs_path]) != safe_srcdir:
+            raise ValueError
+    except ValueError:
+        return None
+
+    return rel_to_source, abs_fs_path
+
+
+# Gallery captions are often repeated verbatim; escape each distinct one once.
+_cached_latex_escape = functools.lru_cache(maxsize=512)(latex_escape)
+
+# Every ASCII character that any texescape table rewrites, for any engine.
+_LATEX_PLAIN_ASCII_RE = re.compile(r"[^#$%&'\-<>\[\\\]^_`{}~]*")
+
+
+def _escape_latex_caption(caption: str, latex_engine: str | None) -> str:
+    """Return *caption* escaped for LaTeX, skipping captions with nothing to escape."""
+    if caption.isascii() and _LATEX_PLAIN_ASCII_RE.fullmatch(caption):
+        return caption
+    return cast(str, _cached_latex_escape(caption, latex_engine))
+
+
+def _clear_caches() -> None:
+    """Drop memoized lookups so a new build sees the current tree and config."""
+    _real_srcdir.cache_clear()
+    _resolve_cached.cache_clear()
+    # texescape.escape() depends on tables populated by the LaTeX builder.
+    _cached_latex_escape.cache_clear()
+
+
 def _sanitize_css_width(width: str) -> str:
     """Return a safe CSS width value for inline thumbnail sizing."""
     width = width.strip()
@@ -170,31 +274,56 @@ def _sanitize_style_attr(style: str) -> str:
     return ""
 
 
+def _thumbnail_img_attrs(custom_class: str, thumbnail_width: str) -> str:
+    """Return the escaped class and style attributes of a legacy thumbnail."""
+    cls = _esc_attr(f"lightbox-trigger {custom_class}".strip())
+    width = _esc_attr(_sanitize_css_width(thumbnail_width))
+    return f' class="{cls}" style="width: {width};"'
+
+
+def _overlay_img_attrs(custom_class: str, size_style: str) -> str:
+    """Return the escaped class and style attributes of an overlay image."""
+    cls = _esc_attr(custom_class.strip())
+    style = _esc_attr(_sanitize_style_attr(size_style)) if size_style else ""
+    class_attr = f' class="{cls}"' if cls else ""
+    style_attr = f' style="{style}"' if style else ""
+    return f"{class_attr}{style_attr}"
+
+
 def _resolve_output_uri(builder: Any, uri: str) -> str:
     """Resolve a source-relative image URI to its HTML output path."""
-    if hasattr(builder, "images") and _has_image_uri(builder.images, uri):
-        imgpath = getattr(builder, "imgpath", "_images")
-        output_uri = builder.images[uri]
-        if isinstance(output_uri, tuple):
-            output_uri = output_uri[1]
-        return f"{imgpath}/{output_uri}"
+    # A single getattr replaces hasattr() plus a second attribute lookup.
+    builder_images = getattr(builder, "images", None)
+    if builder_images is not None and _has_image_uri(builder_images, uri):
+        return _builder_image_path(builder, _output_filename(builder_images[uri]))
 
     duplicate_uri = _resolve_duplicate_output_uri(builder, uri)
     if duplicate_uri:
-        imgpath = getattr(builder, "imgpath", "_images")
-        return f"{imgpath}/{duplicate_uri}"
+        return _builder_image_path(builder, duplicate_uri)
 
     env = getattr(builder, "env", None)
     env_images = getattr(env, "images", None)
     if _has_image_uri(env_images, uri):
-        imgpath = getattr(builder, "imgpath", "_images")
-        output_uri = cast(Any, env_images)[uri]
-        if isinstance(output_uri, tuple):
-            output_uri = output_uri[1]
-        return f"{imgpath}/{output_uri}"
+        return _builder_image_path(builder, _output_filename(cast(Any, env_images)[uri]))
     return uri
 
 
+def _output_filename(image_entry: object) -> str:
+    """Return the output filename from a builder or environment image entry."""
+    # ``env.images`` stores ``(docnames, filename)`` pairs while ``builder.images``
+    # maps straight to the filename.
+    if isinstance(image_entry, tuple):
+        image_entry = image_entry[1]
+    return str(image_entry)
+
+
+def _builder_image_path(builder: Any, filename: str) -> str:
+    """Join an output image filename onto the builder's image path."""
+    # ``imgpath`` is relative to the document being written and Sphinx rewrites
+    # it in every write_doc(), so it must be read per call rather than cached.
+    return getattr(builder, "imgpath", "_images") + "/" + filename
+
+
 def _resolve_duplicate_output_uri(builder: Any, uri: str) -> str:
     """Return Sphinx's copied filename when identical source images are deduped."""
     env = getattr(builder, "env", None)
@@ -214,10 +343,7 @@ def _resolve_duplicate_output_uri(builder: Any, uri: str) -> str:
             continue
         if _image_digest(srcdir, candidate_uri) != source_digest:
             continue
-        output_uri = builder_images[candidate_uri]
-        if isinstance(output_uri, tuple):
-            output_uri = output_uri[1]
-        return str(output_uri)
+        return _output_filename(builder_images[candidate_uri])
 
     return ""
 
@@ -244,6 +370,7 @@ def _has_image_uri(images: Any, uri: str) -> bool:
 
 def _builder_inited(app: Sphinx) -> None:
     """Register the extension's static path natively with Sphinx."""
+    _clear_caches()
     static_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "static"))
     if static_dir not in app.config.html_static_path:
         app.config.html_static_path.append(static_dir)
@@ -334,17 +461,16 @@ def _copy_missing_lightbox_images(app: Sphinx, exception: Exception | None) -> N
     os.makedirs(image_dir, exist_ok=True)
     missing_targets = _missing_html_image_targets(app.outdir)
 
-    for uri, output_uri in getattr(env_images, "items", lambda: [])():
-        if isinstance(output_uri, tuple):
-            output_uri = output_uri[1]
-        if uri not in image_uris and str(output_uri) not in missing_targets:
+    for uri, image_entry in getattr(env_images, "items", lambda: [])():
+        output_uri = _output_filename(image_entry)
+        if uri not in image_uris and output_uri not in missing_targets:
             continue
         if not _has_image_uri(env_images, uri):
             continue
         source_path = _source_image_path(app.env.srcdir, uri)
         if source_path is None:
             continue
-        target_filename = os.path.basename(str(output_uri))
+        target_filename = os.path.basename(output_uri)
         if not target_filename:
             continue
         target_path = os.path.realpath(os.path.abspath(os.path.join(image_dir, target_filename)))
@@ -642,7 +768,6 @@ def transform_lightbox_images(app: Sphinx, doctree: nodes.document, docname: str
         overlay["alt"] = alt_text
         overlay["caption"] = caption
         overlay["legend"] = legend
-        overlay["size_style"] = ""
         overlay["custom_class"] = custom_class
         overlay["checkbox_id"] = checkbox_id
 
@@ -653,6 +778,17 @@ def transform_lightbox_images(app: Sphinx, doctree: nodes.document, docname: str
     assign_lightbox_gallery(app, doctree, docname)
 
 
+def _transform_app(env: Any) -> Sphinx:
+    """Return the application owning a build environment."""
+    # Sphinx 9 moved the application reference from ``env.app`` to ``env._app``.
+    # Read the private attribute first so newer versions never hit the
+    # deprecated compatibility property.
+    app = getattr(env, "_app", None)
+    if app is None:
+        app = env.app
+    return cast(Sphinx, app)
+
+
 class LightboxImageTransform(SphinxPostTransform):
     """Add HTML lightboxes after Sphinx has filtered ``only`` branches."""
 
@@ -660,13 +796,9 @@ class LightboxImageTransform(SphinxPostTransform):
     formats = ("html",)
 
     def run(self, **_kwargs: Any) -> None:
-        # Sphinx 8 introduced ``current_document`` and Sphinx 9 moved the
-        # application reference from ``env.app`` to ``env._app``. Support the
-        # complete declared Sphinx 7-9 range without invoking deprecated
-        # compatibility properties on newer versions.
-        app = getattr(self.env, "_app", None)
-        if app is None:
-            app = self.env.app
+        # Sphinx 8 introduced ``current_document``; see _transform_app() for the
+        # matching application lookup across the supported Sphinx 7-9 range.
+        app = _transform_app(self.env)
         current_document = getattr(self.env, "current_document", None)
         docname = current_document.docname if current_document is not None else self.env.docname
         transform_lightbox_images(
@@ -676,16 +808,69 @@ class LightboxImageTransform(SphinxPostTransform):
         )
 
 
+class LightboxFallbackTransform(SphinxPostTransform):
+    """Reduce legacy lightbox containers to their plain image for other builders."""
+
+    default_priority = 60
+
+    def run(self, **_kwargs: Any) -> None:
+        # The pickled doctree is shared by every builder, so the directive must
+        # keep building the full container; prune it here, on the write copy.
+        builder = _transform_app(self.env).builder
+        if _is_lightbox_html_builder(builder) or getattr(builder, "format", "") == "latex":
+            return
+        for container in list(self.document.findall(LightboxContainer)):
+            fallback = [
+                child
+                for collector in container.findall(LightboxCollector)
+                for child in collector.children
+            ]
+            container.replace_self(fallback)
+
+
 # ---------------------------------------------------------------------------
 # HTML visitors
 # ---------------------------------------------------------------------------
 
+# Markup scaffolding is parsed once here; visitors only substitute values that
+# have already been escaped with _esc_attr().
+_TRIGGER_OPEN_TPL = (
+    '<label for="%(cid)s" class="lightbox-trigger-label">\n'
+    '  <span class="lightbox-trigger-control" role="button" tabindex="0" '
+    'data-lightbox-target="%(cid)s">\n'
+    '    <span class="lightbox-visually-hidden">%(label)s</span>\n'
+)
+_TRIGGER_IMG_TPL = '    <img src="%s" alt=""%s>\n'
+_GALLERY_BUTTON_TPL = (
+    '  <button type="button" class="lightbox-gallery-control lightbox-gallery-%s" '
+    'data-lightbox-target="%s" aria-label="%s">%s</button>\n'
+)
+_OVERLAY_TEXT_TPL = '    <div class="lightbox-text">\n%s%s    </div>\n'
+_CAPTION_TPL = '      <p class="lightbox-caption">%s</p>\n'
+_LEGEND_TPL = '      <div class="lightbox-legend">%s</div>\n'
+_OVERLAY_TPL = (
+    '<input type="checkbox" id="%(cid)s" '
+    'class="lightbox-toggle" aria-hidden="true" tabindex="-1">\n'
+    '<div class="lightbox-overlay" role="dialog" aria-modal="true" '
+    'aria-label="%(alt)s">\n'
+    '  <label for="%(cid)s" class="lightbox-close-label">'
+    '<span class="lightbox-close" role="button" tabindex="0" '
+    'data-lightbox-target="%(cid)s">'
+    '<span aria-hidden="true">&times;</span>'
+    '<span class="lightbox-visually-hidden">%(close)s</span></span></label>\n'
+    "%(buttons)s"
+    '  <div class="lightbox-content">\n'
+    '    <img src="%(src)s" alt="%(alt)s"%(img_attrs)s>\n'
+    "%(text)s"
+    '  </div>\n  <label for="%(cid)s" class="lightbox-backdrop-close"></label>\n</div>\n'
+)
+
 
 def visit_lightbox_container_html(self: Any, node: LightboxContainer) -> None:
     classes = ["lightbox-container"]
     if node.get("align"):
         classes.append(f"align-{node['align']}")
-    class_attr = html_escape(" ".join(classes), quote=True)
+    class_attr = _esc_attr(" ".join(classes))
     self.body.append(f'<div class="{class_attr}">\n')
 
 
@@ -694,31 +879,27 @@ def depart_lightbox_container_html(self: Any, node: LightboxContainer) -> None:
 
 
 def visit_lightbox_trigger_html(self: Any, node: LightboxTrigger) -> None:
-    checkbox_id = html_escape(node["checkbox_id"], quote=True)
+    checkbox_id = _esc_attr(node["checkbox_id"])
     image_name = _accessible_image_name(node.get("alt", ""), node["uri"])
     # Translators: Accessible label for the control that opens an enlarged image.
-    enlarge_label = html_escape(_("Enlarge image: {image}").format(image=image_name), quote=True)
+    enlarge_label = _esc_attr(_("Enlarge image: {image}").format(image=image_name))
 
-    self.body.append(
-        f'<label for="{checkbox_id}" class="lightbox-trigger-label">\n'
-        f'  <span class="lightbox-trigger-control" role="button" tabindex="0" '
-        f'data-lightbox-target="{checkbox_id}">\n'
-        f'    <span class="lightbox-visually-hidden">{enlarge_label}</span>\n'
-    )
+    html = _TRIGGER_OPEN_TPL % {"cid": checkbox_id, "label": enlarge_label}
 
     # Legacy directive nodes do not contain a native image child. Keep their
     # 0.5.x HTML output working without making that duplicate API prominent.
     has_native_thumbnail = next(node.findall(nodes.image), None) is not None
     if not has_native_thumbnail:
-        image_uri = html_escape(_resolve_output_uri(self.builder, node["uri"]), quote=True)
-        custom_class = html_escape(node.get("custom_class", ""), quote=True)
-        thumbnail_width = html_escape(
-            _sanitize_css_width(node.get("thumbnail_width", "100%")), quote=True
-        )
-        cls = f"lightbox-trigger {custom_class}".strip()
-        self.body.append(
-            f'    <img src="{image_uri}" alt="" class="{cls}" style="width: {thumbnail_width};">\n'
-        )
+        image_uri = _esc_attr(_resolve_output_uri(self.builder, node["uri"]))
+        # The compatibility directive renders these attributes once at parse
+        # time; nodes from older pickled environments fall back to doing it here.
+        img_attrs = node.get("img_attrs", None)
+        if img_attrs is None:
+            img_attrs = _thumbnail_img_attrs(
+                node.get("custom_class", ""), node.get("thumbnail_width", "100%")
+            )
+        html += _TRIGGER_IMG_TPL % (image_uri, img_attrs)
+    self.body.append(html)
 
 
 def depart_lightbox_trigger_html(self: Any, node: LightboxTrigger) -> None:
@@ -726,77 +907,50 @@ def depart_lightbox_trigger_html(self: Any, node: LightboxTrigger) -> None:
 
 
 def visit_lightbox_overlay_html(self: Any, node: LightboxOverlay) -> None:
-    checkbox_id = html_escape(node["checkbox_id"], quote=True)
-    image_uri = html_escape(_resolve_output_uri(self.builder, node["uri"]), quote=True)
-    alt_text = html_escape(_accessible_image_name(node.get("alt", ""), node["uri"]), quote=True)
-    caption = html_escape(node.get("caption", ""), quote=True)
-    legend = html_escape(node.get("legend", ""), quote=True)
-    raw_size_style = node.get("size_style", "")
-    size_style = (
-        html_escape(_sanitize_style_attr(raw_size_style), quote=True) if raw_size_style else ""
-    )
-    size_attr = f' style="{size_style}"' if size_style else ""
-    custom_class = html_escape(node.get("custom_class", ""), quote=True)
+    checkbox_id = _esc_attr(node["checkbox_id"])
+    image_uri = _esc_attr(_resolve_output_uri(self.builder, node["uri"]))
+    alt_text = _esc_attr(_accessible_image_name(node.get("alt", ""), node["uri"]))
+    caption = _esc_attr(node.get("caption", ""))
+    legend = _esc_attr(node.get("legend", ""))
+    img_attrs = node.get("img_attrs", None)
+    if img_attrs is None:
+        img_attrs = _overlay_img_attrs(node.get("custom_class", ""), node.get("size_style", ""))
     gallery_index = int(node.get("gallery_index", 0))
     gallery_count = int(node.get("gallery_count", 0))
-    prev_target = html_escape(node.get("gallery_prev_target", ""), quote=True)
-    next_target = html_escape(node.get("gallery_next_target", ""), quote=True)
+    prev_target = _esc_attr(node.get("gallery_prev_target", ""))
+    next_target = _esc_attr(node.get("gallery_next_target", ""))
     # Translators: Accessible label for the previous-image gallery button.
     prev_label_text = _("Previous image in gallery ({index} of {count})")
-    prev_label = html_escape(
-        prev_label_text.format(index=gallery_index, count=gallery_count),
-        quote=True,
-    )
+    prev_label = _esc_attr(prev_label_text.format(index=gallery_index, count=gallery_count))
     # Translators: Accessible label for the next-image gallery button.
     next_label_text = _("Next image in gallery ({index} of {count})")
-    next_label = html_escape(
-        next_label_text.format(index=gallery_index, count=gallery_count),
-        quote=True,
-    )
+    next_label = _esc_attr(next_label_text.format(index=gallery_index, count=gallery_count))
     # Translators: Accessible label for the control that closes the image dialog.
-    close_label = html_escape(_("Close lightbox"), quote=True)
+    close_label = _esc_attr(_("Close lightbox"))
 
-    cls = custom_class.strip() if custom_class else ""
-    self.body.append(
-        f'<input type="checkbox" id="{checkbox_id}" '
-        f'class="lightbox-toggle" aria-hidden="true" tabindex="-1">\n'
-        f'<div class="lightbox-overlay" role="dialog" aria-modal="true" '
-        f'aria-label="{alt_text}">\n'
-        f'  <label for="{checkbox_id}" class="lightbox-close-label">'
-        f'<span class="lightbox-close" role="button" tabindex="0" '
-        f'data-lightbox-target="{checkbox_id}">'
-        f'<span aria-hidden="true">&times;</span>'
-        f'<span class="lightbox-visually-hidden">{close_label}</span></span></label>\n'
-    )
+    buttons = ""
     if prev_target:
-        self.body.append(
-            '  <button type="button" '
-            'class="lightbox-gallery-control lightbox-gallery-prev" '
-            f'data-lightbox-target="{prev_target}" aria-label="{prev_label}">'
-            "&lsaquo;</button>\n"
-        )
+        buttons += _GALLERY_BUTTON_TPL % ("prev", prev_target, prev_label, "&lsaquo;")
     if next_target:
-        self.body.append(
-            '  <button type="button" '
-            'class="lightbox-gallery-control lightbox-gallery-next" '
-            f'data-lightbox-target="{next_target}" aria-label="{next_label}">'
-            "&rsaquo;</button>\n"
-        )
-    self.body.append('  <div class="lightbox-content">\n')
-
-    img_class = f' class="{cls}"' if cls else ""
-    self.body.append(f'    <img src="{image_uri}" alt="{alt_text}"{img_class}{size_attr}>\n')
-
+        buttons += _GALLERY_BUTTON_TPL % ("next", next_target, next_label, "&rsaquo;")
+    text_block = ""
     if caption or legend:
-        self.body.append('    <div class="lightbox-text">\n')
-        if caption:
-            self.body.append(f'      <p class="lightbox-caption">{caption}</p>\n')
-        if legend:
-            self.body.append(f'      <div class="lightbox-legend">{legend}</div>\n')
-        self.body.append("    </div>\n")
+        text_block = _OVERLAY_TEXT_TPL % (
+            _CAPTION_TPL % caption if caption else "",
+            _LEGEND_TPL % legend if legend else "",
+        )
 
     self.body.append(
-        f'  </div>\n  <label for="{checkbox_id}" class="lightbox-backdrop-close"></label>\n</div>\n'
+        _OVERLAY_TPL
+        % {
+            "cid": checkbox_id,
+            "alt": alt_text,
+            "close": close_label,
+            "buttons": buttons,
+            "src": image_uri,
+            "img_attrs": img_attrs,
+            "text": text_block,
+        }
     )
 
 
@@ -808,25 +962,32 @@ def depart_lightbox_overlay_html(self: Any, node: LightboxOverlay) -> None:
 # LaTeX visitors
 # ---------------------------------------------------------------------------
 
+_LATEX_FIGURE_TPL = (
+    "\n\\begin{figure}[htbp]\n\\centering\n"
+    "\\adjustbox{max width=%s\\linewidth}{\\includegraphics{%s}}\n"
+    "%s"
+    "\\end{figure}\n"
+)
+_LATEX_CAPTION_TPL = "\\caption{%s}\n"
+
 
 def visit_lightbox_container_latex(self: Any, node: LightboxContainer) -> None:
     uri = node.get("uri")
-    if hasattr(self.builder, "images") and uri in self.builder.images:
-        image_file = self.builder.images[uri]
+    builder_images = getattr(self.builder, "images", None)
+    if builder_images is not None and uri in builder_images:
+        image_file = builder_images[uri]
     else:
         image_file = os.path.basename(uri)
 
     latex_width = node.get("latex_width", "0.95")
     caption = node.get("caption", "")
+    # Unicode engines take non-ASCII text as is, like Sphinx's own escaping.
+    latex_engine = getattr(self.builder.config, "latex_engine", None)
 
-    self.body.append("\n\\begin{figure}[htbp]\n\\centering\n")
-    self.body.append(
-        f"\\adjustbox{{max width={latex_width}\\linewidth}}{{\\includegraphics{{{image_file}}}}}\n"
+    caption_tex = (
+        _LATEX_CAPTION_TPL % _escape_latex_caption(caption, latex_engine) if caption else ""
     )
-    if caption:
-        escaped_caption = latex_escape(caption)
-        self.body.append(f"\\caption{{{escaped_caption}}}\n")
-    self.body.append("\\end{figure}\n")
+    self.body.append(_LATEX_FIGURE_TPL % (latex_width, image_file, caption_tex))
 
     raise nodes.SkipNode
 
@@ -835,6 +996,12 @@ def visit_lightbox_container_latex(self: Any, node: LightboxContainer) -> None:
 # Directive
 # ---------------------------------------------------------------------------
 
+# Fit the overlay image inside pct% of the viewport while keeping its ratio.
+_SIZE_STYLE_TPL = (
+    "width: min(%(pct)svw, calc(%(pct)svh * %(ratio)s));"
+    "height: min(%(pct)svh, calc(%(pct)svw / %(ratio)s));"
+)
+
 
 class LightboxDirective(SphinxDirective):
     """Compatibility directive retained for documents authored with 0.5.x."""
@@ -863,15 +1030,15 @@ class LightboxDirective(SphinxDirective):
         if image_path is None:
             return []
 
-        env.images.add_file(env.docname, image_path)
         _register_lightbox_image(env, env.docname, image_path)
 
-        abs_fs_path = os.path.normpath(os.path.join(env.srcdir, image_path.replace("/", os.sep)))
+        abs_fs_path = os.path.normpath(os.path.join(env.srcdir, _to_native(image_path)))
         aspect_ratio = 1.0
         try:
-            from sphinx.util.images import get_image_size
-
-            width, height = get_image_size(abs_fs_path)
+            size = _image_size(abs_fs_path)
+            if size is None:
+                raise ValueError("unsupported image format")
+            width, height = size
             if width and height:
                 aspect_ratio = width / height
         except Exception as e:
@@ -932,13 +1099,18 @@ class LightboxDirective(SphinxDirective):
         overlay["uri"] = image_path
         overlay["alt"] = alt_text
         overlay["caption"] = caption
-        overlay["size_style"] = (
-            f"width: min({lightbox_pct}vw, calc({lightbox_pct}vh * {aspect_ratio:.4f}));"
-            f"height: min({lightbox_pct}vh, calc({lightbox_pct}vw / {aspect_ratio:.4f}));"
-        )
+        overlay["size_style"] = _SIZE_STYLE_TPL % {
+            "pct": lightbox_pct,
+            "ratio": format(aspect_ratio, ".4f"),
+        }
         overlay["custom_class"] = custom_class
         overlay["checkbox_id"] = checkbox_id
 
+        # Escape and validate the static image attributes once while parsing
+        # instead of on every HTML write of this document.
+        trigger["img_attrs"] = _thumbnail_img_attrs(custom_class, thumbnail_width)
+        overlay["img_attrs"] = _overlay_img_attrs(custom_class, overlay["size_style"])
+
         container += trigger
         container += overlay
 
@@ -948,24 +1120,12 @@ class LightboxDirective(SphinxDirective):
 
     def _resolve_image_path(self, raw_path: str) -> str | None:
         env = self.env
-        if raw_path.startswith("/"):
-            rel_to_source = raw_path.lstrip("/")
-        else:
-            current_dir = posixpath.dirname(env.docname)
-            rel_to_source = posixpath.normpath(posixpath.join(current_dir, raw_path))
-
-        # Resolve symlinks as well as ``..`` components before checking the
-        # boundary; otherwise a path inside srcdir can point to an outside file.
-        abs_fs_path = os.path.realpath(
-            os.path.abspath(os.path.join(env.srcdir, rel_to_source.replace("/", os.sep)))
-        )
-        safe_srcdir = os.path.realpath(os.path.abspath(env.srcdir))
+        # Root-relative paths do not depend on the document's directory, so
+        # key them on "" to share one cache entry per image.
+        docname_dir = "" if raw_path.startswith("/") else posixpath.dirname(env.docname)
+        resolved = _resolve_cached(env.srcdir, docname_dir, raw_path)
 
-        # Compare the common path to ensure the target is strictly inside srcdir
-        try:
-            if os.path.commonpath([safe_srcdir, abs_fs_path]) != safe_srcdir:
-                raise ValueError
-        except ValueError:
+        if resolved is None:
             logger.warning(
                 _("Lightbox image path traverses outside source directory: {path}").format(
                     path=raw_path
@@ -976,6 +1136,7 @@ class LightboxDirective(SphinxDirective):
             )
             return None
 
+        rel_to_source, abs_fs_path = resolved
         if not os.path.isfile(abs_fs_path):
             logger.warning(
                 _("Lightbox image not found: {path}").format(path=abs_fs_path),
@@ -1029,21 +1190,17 @@ def setup(app: Sphinx) -> dict[str, Any]:
         man=(visit_noop, skip_departure),
         texinfo=(visit_noop, skip_departure),
     )
-    app.add_node(
-        LightboxCollector,
-        html=(_visit_skip, skip_departure),
-        latex=(visit_noop, skip_departure),
-        epub=(visit_noop, skip_departure),
-        text=(visit_noop, skip_departure),
-        man=(visit_noop, skip_departure),
-        texinfo=(visit_noop, skip_departure),
-    )
+    # Collectors only reach interactive HTML writers: the LaTeX container
+    # visitor skips its children and LightboxFallbackTransform unwraps them
+    # for every other builder.
+    app.add_node(LightboxCollector, html=(_visit_skip, skip_departure))
 
     app.add_directive("lightbox", LightboxDirective)
     app.connect("builder-inited", _builder_inited)
     app.connect("env-purge-doc", _purge_lightbox_images)
     app.connect("env-merge-info", _merge_lightbox_images)
     app.add_post_transform(LightboxImageTransform)
+    app.add_post_transform(LightboxFallbackTransform)
     app.connect("build-finished", _copy_missing_lightbox_images)
     app.add_css_file("lightbox.css")
     app.add_js_file("lightbox.js")
@@ -9,6 +9,11 @@ from pathlib import Path
 
 from playwright.async_api import Browser, Locator, Page, async_playwright
 
+# The <script> tag that loads the lightbox enhancement, with leading whitespace.
+_LIGHTBOX_SCRIPT_TAG_RE = re.compile(
+    r'\s*<script\b[^>]*\bsrc="[^"]*lightbox\.js[^"]*"[^>]*></script>'
+)
+
 
 async def _wait_for_focus(
     page: Page,
@@ -236,11 +241,7 @@ async def _exercise_single_image(browser: Browser, index_path: Path) -> None:
 async def _exercise_late_script_load(browser: Browser, index_path: Path) -> None:
     """Verify initialization when the enhancement is loaded after DOMContentLoaded."""
     html = index_path.read_text(encoding="utf-8")
-    html = re.sub(
-        r'\s*<script\b[^>]*\bsrc="[^"]*lightbox\.js[^"]*"[^>]*></script>',
-        "",
-        html,
-    )
+    html = _LIGHTBOX_SCRIPT_TAG_RE.sub("", html)
     base_url = f"{index_path.parent.resolve().as_uri()}/"
     html = html.replace("<head>", f'<head><base href="{base_url}">', 1)
 
@@ -27,6 +27,11 @@ _SDIST_ROOT_FILES = {
     "pyproject.toml",
     "setup.cfg",
 }
+# Header line of [project], then every following line up to the next table
+# header. Consuming whole lines avoids the per-character lookahead and lazy
+# backtracking of a DOTALL ``.*?`` scan.
+_PROJECT_TABLE_RE = re.compile(r"^\[project\][^\n]*\n?((?:(?!\[)[^\n]*\n?)*)", re.MULTILINE)
+_PROJECT_VERSION_RE = re.compile(r'^version\s*=\s*"([^"]+)"\s*$', re.MULTILINE)
 _SDIST_REQUIRED = {
     "LICENSE",
     "MANIFEST.in",
@@ -289,10 +294,10 @@ def _archive_errors(
 def _project_version(pyproject_path: Path) -> str | None:
     """Read the static ``project.version`` value without adding a TOML dependency."""
     content = pyproject_path.read_text(encoding="utf-8")
-    project_match = re.search(r"(?ms)^\[project\]\s*(.*?)(?=^\[|\Z)", content)
+    project_match = _PROJECT_TABLE_RE.search(content)
     if project_match is None:
         return None
-    version_match = re.search(r'^version\s*=\s*"([^"]+)"\s*$', project_match.group(1), re.MULTILINE)
+    version_match = _PROJECT_VERSION_RE.search(project_match.group(1))
     return version_match.group(1) if version_match is not None else None
 
 
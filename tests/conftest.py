@@ -4,11 +4,18 @@ This file contains reusable test fixtures and pytest configuration
 that is shared across all test modules.
 """
 
+import os
+from collections import defaultdict
+from itertools import count
 from pathlib import Path
+from types import SimpleNamespace
 from unittest.mock import Mock
 
 import pytest
-from sphinx.util import texescape
+from sphinx.application import Sphinx
+
+from lightbox.lightbox import _clear_caches, setup
+from tests.helpers import StubBuilder
 
 pytest_plugins = "sphinx.testing.fixtures"
 
@@ -16,11 +23,16 @@ pytest_plugins = "sphinx.testing.fixtures"
 # One-time initialisation
 # ---------------------------------------------------------------------------
 
-# sphinx.util.texescape.escape() is a no-op until init() populates the
-# replacement table. Sphinx normally calls this during app startup; we
-# must do it explicitly so unit tests that call latex_escape() directly
-# (without booting a full Sphinx application) get correct escaping.
-texescape.init()
+
+def pytest_configure(config: pytest.Config) -> None:
+    # sphinx.util.texescape.escape() is a no-op until init() populates the
+    # replacement table. Sphinx normally calls this during app startup; we
+    # must do it explicitly so unit tests that call latex_escape() directly
+    # (without booting a full Sphinx application) get correct escaping.
+    # Running it from the pytest lifecycle keeps it off conftest import.
+    from sphinx.util import texescape
+
+    texescape.init()
 
 
 # ---------------------------------------------------------------------------
@@ -41,49 +53,90 @@ def rootdir() -> object:
     return sphinx_test_path(root)
 
 
-@pytest.fixture
-def mock_builder():
+@pytest.fixture(scope="session")
+def configured_app() -> Mock:
     """
-    Mock Sphinx builder with minimal required attributes.
-    Provides just enough to test LaTeX visitor functions without
-    running a full Sphinx build.
+    Mock application that lightbox's setup() has already registered with.
+    Created once per session; tests only read the recorded registration
+    calls, so they can share it.
     """
-    builder = Mock()
-    builder.name = "latex"
-    builder.images = {}  # URI → output filename mapping
+    # Speccing against Sphinx rejects attributes the real application lacks.
+    app = Mock(spec=Sphinx)
+    setup(app)
+    return app
 
-    translator = Mock()
-    translator.body = []  # Collects LaTeX output fragments
-    translator.builder = builder
 
-    builder.translator = translator
+@pytest.fixture(scope="session")
+def mock_state_machine() -> Mock:
+    """
+    Directive state machine that always reports the same source location.
+    Created once per session; directives only ask it where they are.
+    """
+    state_machine = Mock()
+    state_machine.get_source_and_line.return_value = ("test.rst", 10)
+    return state_machine
 
-    return builder
+
+@pytest.fixture(autouse=True)
+def clear_lightbox_caches():
+    """Keep memoized filesystem lookups from leaking between tests."""
+    _clear_caches()
+    yield
+    _clear_caches()
+
+
+@pytest.fixture
+def mock_builder():
+    """
+    Stub Sphinx builder with minimal required attributes.
+    Provides just enough to test LaTeX visitor functions without
+    running a full Sphinx build. Plain objects are used instead of Mock
+    because no test inspects calls on the builder or translator.
+    """
+    return StubBuilder()
 
 
 @pytest.fixture
 def sphinx_env(monkeypatch: pytest.MonkeyPatch):
     """
-    Mock Sphinx environment with minimal required attributes.
-    Provides docname, srcdir, and an images collection without
+    Stub Sphinx environment with minimal required attributes.
+    Provides docname, srcdir, and a serial number source without
     needing a full Sphinx application instance.
     """
-    env = Mock()
-    env.docname = "test"
-    env.srcdir = "/tmp/test-sphinx"
-
-    env.images = Mock()
-    env.images.add_file = Mock()
-    monkeypatch.setattr("sphinx.util.images.get_image_size", lambda _path: (1, 1))
+    monkeypatch.setattr("lightbox.lightbox.get_image_size", lambda _path: (1, 1))
 
-    _serial_counters: dict = {}
+    _serial_counters: defaultdict[str, count[int]] = defaultdict(lambda: count(1))
 
     def new_serialno(category: str) -> int:
         """Generates unique IDs for nodes like checkboxes."""
-        _serial_counters.setdefault(category, 0)
-        _serial_counters[category] += 1
-        return _serial_counters[category]
+        return next(_serial_counters[category])
+
+    return SimpleNamespace(
+        docname="test",
+        srcdir="/tmp/test-sphinx",
+        new_serialno=new_serialno,
+    )
+
+
+@pytest.fixture
+def directive_state(sphinx_env: SimpleNamespace, mock_state_machine: Mock) -> tuple[Mock, Mock]:
+    """
+    (state, state_machine) pair for constructing directives by hand.
+    The state exposes sphinx_env as the document's environment, so tests
+    can keep adjusting sphinx_env after the directive is created.
+    """
+    state = Mock()
+    state.document.settings.env = sphinx_env
+    return state, mock_state_machine
 
-    env.new_serialno = new_serialno
 
-    return env
+@pytest.fixture
+def isfile_true(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Make every image path the directive checks look like an existing file."""
+    monkeypatch.setattr(os.path, "isfile", lambda _path: True)
+
+
+@pytest.fixture
+def isfile_false(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Make every image path the directive checks look missing."""
+    monkeypatch.setattr(os.path, "isfile", lambda _path: False)
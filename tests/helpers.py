@@ -1,8 +1,13 @@
 from __future__ import annotations
 
+import textwrap
+from collections.abc import Mapping
 from pathlib import Path
+from types import SimpleNamespace
+from typing import TypeVar, cast
 
 from bs4 import BeautifulSoup
+from docutils import nodes
 from sphinx.testing.util import SphinxTestApp
 
 _PNG_BYTES = (
@@ -12,6 +17,48 @@ _PNG_BYTES = (
     b"\x18\xdd\x8d\xb0\x00\x00\x00\x00IEND\xaeB`\x82"
 )
 
+_NodeT = TypeVar("_NodeT", bound=nodes.Node)
+
+
+class RecordingTranslator:
+    """Translator stand-in that only collects output fragments."""
+
+    __slots__ = ("body", "builder", "_joined", "_joined_parts")
+
+    def __init__(self, builder: StubBuilder) -> None:
+        self.body: list[str] = []  # Collects visitor output fragments
+        self.builder = builder
+        self._joined = ""
+        self._joined_parts = 0
+
+    def rendered(self) -> str:
+        """Return the joined output, re-joining only after body has grown."""
+        # Visitors only ever append to body, so its length identifies the join.
+        if self._joined_parts != len(self.body):
+            self._joined = "".join(self.body)
+            self._joined_parts = len(self.body)
+        return self._joined
+
+
+class StubBuilder:
+    """Builder stand-in with the attributes the HTML and LaTeX visitors read."""
+
+    __slots__ = ("name", "config", "images", "translator")
+
+    def __init__(self) -> None:
+        self.name = "latex"
+        self.config: SimpleNamespace | None = None
+        self.images: dict[str, str] = {}  # URI → output filename mapping
+        self.translator = RecordingTranslator(self)
+
+
+def child_of_type(parent: nodes.Element, cls: type[_NodeT]) -> _NodeT:
+    """Return the first child of parent whose type is exactly cls."""
+    for child in parent.children:
+        if type(child) is cls:
+            return cast(_NodeT, child)
+    raise AssertionError(f"no {cls.__name__} child in {type(parent).__name__}")
+
 
 def write_image(app: SphinxTestApp, relative_path: str = "images/example.png") -> None:
     image_path = Path(app.srcdir).joinpath(relative_path)
@@ -19,6 +66,17 @@ def write_image(app: SphinxTestApp, relative_path: str = "images/example.png") -
     image_path.write_bytes(_PNG_BYTES)
 
 
+def write_project(srcdir: Path, files: Mapping[str, str | bytes]) -> None:
+    """Write a standalone Sphinx project from relative paths to file contents."""
+    for relative_path, content in files.items():
+        path = srcdir / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(content, bytes):
+            path.write_bytes(content)
+        else:
+            path.write_text(textwrap.dedent(content), encoding="utf-8")
+
+
 def write_index(app: SphinxTestApp, content: str) -> None:
     Path(app.srcdir).joinpath("index.rst").write_text(content, encoding="utf-8")
 
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import posixpath
 from pathlib import Path
+from types import SimpleNamespace
 from unittest.mock import Mock, patch
 
 import pytest
@@ -18,6 +20,7 @@ from lightbox.lightbox import (
     _copy_missing_lightbox_images,
     _gallery_mode,
     _image_digest,
+    _is_remote_or_data_uri,
     _is_transform_candidate,
     _lightbox_images_by_doc,
     _merge_lightbox_images,
@@ -25,6 +28,7 @@ from lightbox.lightbox import (
     _overlay_for_container,
     _policy,
     _register_lightbox_image,
+    _resolve_cached,
     _resolve_duplicate_output_uri,
     _resolve_output_uri,
     _source_image_path,
@@ -34,6 +38,9 @@ from lightbox.lightbox import (
     visit_lightbox_container_html,
     visit_noop,
 )
+from tests.helpers import StubBuilder, child_of_type
+
+pytestmark = pytest.mark.unit
 
 
 def _copy_app(tmp_path: Path, env_images: object, image_uris: set[str] | None = None) -> Mock:
@@ -58,11 +65,8 @@ def _write_source_image(app: Mock, uri: str = "images/missing.png") -> None:
     source_image.write_bytes(b"image")
 
 
-def _directive(sphinx_env: Mock, image: str = "/i.png") -> LightboxDirective:
-    state = Mock()
-    state.document.settings.env = sphinx_env
-    state_machine = Mock()
-    state_machine.get_source_and_line.return_value = ("test.rst", 10)
+def _directive(directive_state: tuple[Mock, Mock], image: str = "/i.png") -> LightboxDirective:
+    state, state_machine = directive_state
     return LightboxDirective("lightbox", [image], {}, [], 1, 0, "", state, state_machine)
 
 
@@ -77,7 +81,6 @@ def _container(checkbox_id: str = "lb-1") -> tuple[LightboxContainer, LightboxOv
     return container, overlay
 
 
-@pytest.mark.unit
 def test_source_image_path_rejects_empty_remote_and_commonpath_errors() -> None:
     assert _source_image_path("", "images/example.png") is None
     assert _source_image_path("/docs", "https://example.invalid/image.png") is None
@@ -87,14 +90,75 @@ def test_source_image_path_rejects_empty_remote_and_commonpath_errors() -> None:
         assert _source_image_path("/docs", "images/example.png") is None
 
 
-@pytest.mark.unit
+def test_source_image_path_resolves_relative_srcdir(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    (tmp_path / "docs" / "images").mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+
+    resolved = _source_image_path("docs", "/images/example.png")
+
+    assert resolved == str((tmp_path / "docs" / "images" / "example.png").resolve())
+    assert _source_image_path("docs", "../outside.png") is None
+
+
+@pytest.mark.parametrize("docname_dir", ["", "guide", "guide/nested"])
+@pytest.mark.parametrize(
+    "raw_path",
+    [
+        "image.png",
+        "images/image.png",
+        "./image.png",
+        "images/./image.png",
+        "images//image.png",
+        "images/",
+        "../image.png",
+        "images/../image.png",
+        "images/.hidden.png",
+        "images/..data/image.png",
+        ".",
+    ],
+)
+def test_resolved_source_path_matches_normpath(
+    tmp_path: Path, docname_dir: str, raw_path: str
+) -> None:
+    (tmp_path / "guide" / "nested").mkdir(parents=True)
+    expected = posixpath.normpath(posixpath.join(docname_dir, raw_path))
+
+    resolved = _resolve_cached(str(tmp_path), docname_dir, raw_path)
+
+    if expected.startswith(".."):
+        assert resolved is None
+    else:
+        assert resolved is not None
+        assert resolved[0] == expected
+
+
+@pytest.mark.parametrize(
+    ("uri", "expected"),
+    [
+        ("https://example.invalid/a.png", True),
+        ("HTTP://example.invalid/a.png", True),
+        ("  data:image/png;base64,AAAA", True),
+        ("//cdn.example.invalid/a.png", True),
+        ("Custom+Scheme.v1:payload", True),
+        ("images/a.png", False),
+        ("/images/a.png", False),
+        ("images/http:/a.png", False),
+        ("1http://example.invalid/a.png", False),
+        ("", False),
+    ],
+)
+def test_is_remote_or_data_uri(uri: str, expected: bool) -> None:
+    assert _is_remote_or_data_uri(uri) is expected
+
+
 def test_accessible_image_name_uses_alt_filename_and_generic_fallbacks() -> None:
     assert _accessible_image_name(" Explicit name ", "images/ignored.png") == "Explicit name"
     assert _accessible_image_name("", "images/server_diagram-final.png") == "server diagram final"
     assert _accessible_image_name("", "") == "Image"
 
 
-@pytest.mark.unit
 def test_source_image_path_rejects_symlinks_outside_srcdir(tmp_path: Path) -> None:
     srcdir = tmp_path / "src"
     srcdir.mkdir()
@@ -109,7 +173,6 @@ def test_source_image_path_rejects_symlinks_outside_srcdir(tmp_path: Path) -> No
     assert _source_image_path(str(srcdir), "linked.png") is None
 
 
-@pytest.mark.unit
 def test_image_digest_handles_unresolved_and_unreadable_images() -> None:
     assert _image_digest("/docs", "data:image/png;base64,AAAA") is None
 
@@ -117,20 +180,20 @@ def test_image_digest_handles_unresolved_and_unreadable_images() -> None:
         assert _image_digest("/docs", "images/example.png") is None
 
 
-@pytest.mark.unit
 def test_resolve_output_uri_handles_tuple_and_plain_environment_mappings() -> None:
-    builder = Mock(images={"images/example.png": ({"index"}, "example-hash.png")})
-    builder.imgpath = "_images"
+    builder = SimpleNamespace(
+        images={"images/example.png": ({"index"}, "example-hash.png")}, imgpath="_images"
+    )
     assert _resolve_output_uri(builder, "images/example.png") == "_images/example-hash.png"
 
-    builder = Mock()
-    builder.images = {}
-    builder.imgpath = "_images"
-    builder.env.images = {"images/example.png": "plain-name.png"}
+    builder = SimpleNamespace(
+        images={},
+        imgpath="_images",
+        env=SimpleNamespace(images={"images/example.png": "plain-name.png"}),
+    )
     assert _resolve_output_uri(builder, "images/example.png") == "_images/plain-name.png"
 
 
-@pytest.mark.unit
 def test_resolve_duplicate_output_uri_handles_digest_edge_cases(tmp_path: Path) -> None:
     image_dir = tmp_path / "images"
     image_dir.mkdir()
@@ -138,13 +201,16 @@ def test_resolve_duplicate_output_uri_handles_digest_edge_cases(tmp_path: Path)
     (image_dir / "different.png").write_bytes(b"different")
     (image_dir / "same.png").write_bytes(b"first")
 
-    builder = Mock()
-    builder.env.srcdir = str(tmp_path)
-    builder.env.images = {
-        "images/first.png": "first.png",
-        "images/different.png": "different.png",
-    }
-    builder.images = {"images/different.png": "different.png"}
+    builder = SimpleNamespace(
+        env=SimpleNamespace(
+            srcdir=str(tmp_path),
+            images={
+                "images/first.png": "first.png",
+                "images/different.png": "different.png",
+            },
+        ),
+        images={"images/different.png": "different.png"},
+    )
     assert _resolve_duplicate_output_uri(builder, "images/first.png") == ""
 
     builder.env.images = {
@@ -161,7 +227,6 @@ def test_resolve_duplicate_output_uri_handles_digest_edge_cases(tmp_path: Path)
     assert _resolve_duplicate_output_uri(builder, "images/missing.png") == ""
 
 
-@pytest.mark.unit
 def test_environment_image_metadata_ignores_malformed_values() -> None:
     env = Mock()
     env.lightbox_image_uris_by_doc = {
@@ -173,7 +238,6 @@ def test_environment_image_metadata_ignores_malformed_values() -> None:
     assert _lightbox_images_by_doc(env) == {"index": {"1", "images/example.png"}}
 
 
-@pytest.mark.unit
 def test_register_lightbox_image_ignores_empty_normalized_uri() -> None:
     env = Mock()
     env.lightbox_image_uris_by_doc = {"index": {"images/existing.png"}}
@@ -183,7 +247,6 @@ def test_register_lightbox_image_ignores_empty_normalized_uri() -> None:
     assert env.lightbox_image_uris_by_doc == {"index": {"images/existing.png"}}
 
 
-@pytest.mark.unit
 def test_merge_lightbox_images_skips_unrequested_docs() -> None:
     env = Mock()
     env.lightbox_image_uris_by_doc = {}
@@ -195,7 +258,6 @@ def test_merge_lightbox_images_skips_unrequested_docs() -> None:
     assert env.lightbox_image_uris_by_doc == {}
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_returns_when_build_failed() -> None:
     app = Mock()
     app.builder.format = "html"
@@ -206,7 +268,6 @@ def test_copy_missing_lightbox_images_returns_when_build_failed() -> None:
     makedirs.assert_not_called()
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_skips_unreferenced_images(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, {"images/unused.png": "unused.png"})
     _write_source_image(app, "images/unused.png")
@@ -216,7 +277,6 @@ def test_copy_missing_lightbox_images_skips_unreferenced_images(tmp_path: Path)
     assert not Path(app.outdir, "_images", "unused.png").exists()
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_rejects_escaping_image_dir(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, {})
     app.builder.imagedir = "../escaped-images"
@@ -228,7 +288,6 @@ def test_copy_missing_lightbox_images_rejects_escaping_image_dir(tmp_path: Path)
     assert logger.warning.call_args.kwargs["subtype"] == "unsafe_image_dir"
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_rejects_symlinked_image_dir(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, {})
     outside = tmp_path / "outside-images"
@@ -245,7 +304,6 @@ def test_copy_missing_lightbox_images_rejects_symlinked_image_dir(tmp_path: Path
     assert logger.warning.call_args.kwargs["subtype"] == "unsafe_image_dir"
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_ignores_image_dir_commonpath_errors(
     tmp_path: Path,
 ) -> None:
@@ -268,7 +326,6 @@ class _ItemsWithoutContains:
         return False
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_respects_image_mapping_membership(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, _ItemsWithoutContains(), {"images/missing.png"})
     _write_source_image(app)
@@ -278,7 +335,6 @@ def test_copy_missing_lightbox_images_respects_image_mapping_membership(tmp_path
     assert not Path(app.outdir, "_images", "missing.png").exists()
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_skips_empty_target_filename(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, {"images/missing.png": ""}, {"images/missing.png"})
     _write_source_image(app)
@@ -288,7 +344,6 @@ def test_copy_missing_lightbox_images_skips_empty_target_filename(tmp_path: Path
     assert list(Path(app.outdir, "_images").iterdir()) == []
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_skips_target_outside_image_dir(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, {"images/missing.png": "missing.png"}, {"images/missing.png"})
     _write_source_image(app)
@@ -306,7 +361,6 @@ def test_copy_missing_lightbox_images_skips_target_outside_image_dir(tmp_path: P
     assert not Path(app.outdir, "_images", "missing.png").exists()
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_rejects_symlinked_target(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, {"images/missing.png": "missing.png"}, {"images/missing.png"})
     _write_source_image(app)
@@ -323,7 +377,6 @@ def test_copy_missing_lightbox_images_rejects_symlinked_target(tmp_path: Path) -
     assert not outside.exists()
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_ignores_target_commonpath_errors(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, {"images/missing.png": "missing.png"}, {"images/missing.png"})
     _write_source_image(app)
@@ -341,7 +394,6 @@ def test_copy_missing_lightbox_images_ignores_target_commonpath_errors(tmp_path:
     assert not Path(app.outdir, "_images", "missing.png").exists()
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_warns_when_copy_fails(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, {"images/missing.png": "missing.png"}, {"images/missing.png"})
     _write_source_image(app)
@@ -355,7 +407,6 @@ def test_copy_missing_lightbox_images_warns_when_copy_fails(tmp_path: Path) -> N
     assert logger.warning.call_args.kwargs["subtype"] == "copy_image"
 
 
-@pytest.mark.unit
 def test_copy_missing_lightbox_images_leaves_existing_target_untouched(tmp_path: Path) -> None:
     app = _copy_app(tmp_path, {"images/missing.png": "missing.png"}, {"images/missing.png"})
     _write_source_image(app)
@@ -369,7 +420,6 @@ def test_copy_missing_lightbox_images_leaves_existing_target_untouched(tmp_path:
     assert target.read_bytes() == b"existing"
 
 
-@pytest.mark.unit
 def test_missing_html_image_targets_ignores_unreadable_html(tmp_path: Path) -> None:
     outdir = tmp_path / "html"
     outdir.mkdir()
@@ -379,7 +429,6 @@ def test_missing_html_image_targets_ignores_unreadable_html(tmp_path: Path) -> N
         assert _missing_html_image_targets(str(outdir)) == set()
 
 
-@pytest.mark.unit
 def test_invalid_transform_policy_warns_and_falls_back() -> None:
     app = Mock()
     app.config.lightbox_images = "invalid"
@@ -390,7 +439,6 @@ def test_invalid_transform_policy_warns_and_falls_back() -> None:
     assert logger.warning.call_args.kwargs["subtype"] == "invalid_config"
 
 
-@pytest.mark.unit
 def test_invalid_gallery_mode_warns_and_falls_back() -> None:
     app = Mock()
     app.config.lightbox_gallery = "invalid"
@@ -401,7 +449,6 @@ def test_invalid_gallery_mode_warns_and_falls_back() -> None:
     assert logger.warning.call_args.kwargs["subtype"] == "invalid_config"
 
 
-@pytest.mark.unit
 def test_transform_candidate_ignores_linked_images() -> None:
     app = Mock()
     image = nodes.image(uri="images/example.png", classes=["lightbox"])
@@ -410,7 +457,6 @@ def test_transform_candidate_ignores_linked_images() -> None:
     assert _is_transform_candidate(app, image) is False
 
 
-@pytest.mark.unit
 def test_container_lookup_helpers_handle_missing_children() -> None:
     container = LightboxContainer()
     container += nodes.paragraph("", "ignored")
@@ -420,7 +466,6 @@ def test_container_lookup_helpers_handle_missing_children() -> None:
     assert _overlay_for_container(container) is None
 
 
-@pytest.mark.unit
 def test_clear_gallery_metadata_removes_existing_attributes() -> None:
     overlay = LightboxOverlay()
     overlay["gallery_id"] = "gallery"
@@ -440,7 +485,6 @@ def test_clear_gallery_metadata_removes_existing_attributes() -> None:
     assert overlay["caption"] == "Caption"
 
 
-@pytest.mark.unit
 def test_assign_gallery_tolerates_overlay_lookup_changes() -> None:
     first, first_overlay = _container("lb-1")
     second, second_overlay = _container("lb-2")
@@ -467,33 +511,29 @@ def test_assign_gallery_tolerates_overlay_lookup_changes() -> None:
     assert second_overlay["gallery_prev_target"] == "lb-1"
 
 
-@pytest.mark.unit
 def test_lightbox_container_html_includes_alignment_class() -> None:
-    translator = Mock()
-    translator.body = []
+    translator = StubBuilder().translator
     node = LightboxContainer()
     node["align"] = "center"
 
     visit_lightbox_container_html(translator, node)
 
-    assert 'class="lightbox-container align-center"' in "".join(translator.body)
+    assert 'class="lightbox-container align-center"' in translator.rendered()
 
 
-@pytest.mark.unit
-def test_directive_keeps_square_ratio_when_image_size_is_incomplete(sphinx_env: Mock) -> None:
-    directive = _directive(sphinx_env, "/zero-width.png")
+def test_directive_keeps_square_ratio_when_image_size_is_incomplete(
+    directive_state: tuple[Mock, Mock],
+    isfile_true: None,
+) -> None:
+    directive = _directive(directive_state, "/zero-width.png")
 
-    with (
-        patch("lightbox.lightbox.os.path.isfile", return_value=True),
-        patch("sphinx.util.images.get_image_size", return_value=(0, 400)),
-    ):
+    with patch("lightbox.lightbox.get_image_size", return_value=(0, 400)):
         result = directive.run()
 
-    overlay = next(node for node in result[0].children if isinstance(node, LightboxOverlay))
+    overlay = child_of_type(result[0], LightboxOverlay)
     assert "1.0000" in overlay["size_style"]
 
 
-@pytest.mark.unit
 def test_post_transform_uses_current_document_docname() -> None:
     doctree = nodes.document("", "")
     doctree.settings = Mock()
@@ -508,7 +548,6 @@ def test_post_transform_uses_current_document_docname() -> None:
     transform.assert_called_once_with(doctree.settings.env._app, doctree, "nested/page")
 
 
-@pytest.mark.unit
 def test_post_transform_supports_sphinx_seven_environment() -> None:
     doctree = nodes.document("", "")
     doctree.settings = Mock()
@@ -525,7 +564,6 @@ def test_post_transform_supports_sphinx_seven_environment() -> None:
     transform.assert_called_once_with(doctree.settings.env.app, doctree, "legacy/page")
 
 
-@pytest.mark.unit
 def test_required_sphinx_noop_visitors_are_callable() -> None:
     translator = Mock()
     node = nodes.Element()
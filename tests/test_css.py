@@ -2,11 +2,19 @@
 
 from pathlib import Path
 
+import pytest
+
 CSS_PATH = Path(__file__).resolve().parents[1] / "lightbox" / "static" / "lightbox.css"
 
 
-def test_caption_and_legend_use_one_dark_background_panel() -> None:
-    source = CSS_PATH.read_text(encoding="utf-8")
+@pytest.fixture(scope="session")
+def css_source() -> str:
+    # The stylesheet is read-only test input, so one read serves every test.
+    return CSS_PATH.read_text(encoding="utf-8")
+
+
+def test_caption_and_legend_use_one_dark_background_panel(css_source: str) -> None:
+    source = css_source
 
     assert ".lightbox-text {" in source
     assert "background: rgba(0, 0, 0, 0.92);" in source
@@ -15,9 +23,8 @@ def test_caption_and_legend_use_one_dark_background_panel() -> None:
     assert ".lightbox-caption + .lightbox-legend" in source
 
 
-def test_high_contrast_caption_panel_is_solid() -> None:
-    source = CSS_PATH.read_text(encoding="utf-8")
-    high_contrast = source.split("@media (prefers-contrast: more)", 1)[1]
+def test_high_contrast_caption_panel_is_solid(css_source: str) -> None:
+    high_contrast = css_source.split("@media (prefers-contrast: more)", 1)[1]
 
     assert ".lightbox-text" in high_contrast
     assert "background: #000;" in high_contrast
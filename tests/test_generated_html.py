@@ -1,22 +1,19 @@
 from __future__ import annotations
 
+import re
 import subprocess
 import sys
-import textwrap
 from pathlib import Path
 
 import pytest
 from bs4 import BeautifulSoup
 from sphinx.testing.util import SphinxTestApp
 
-from tests.helpers import build_index, html_soup, html_text, write_image
+from lightbox.lightbox import LightboxContainer
+from tests.helpers import _PNG_BYTES, build_index, html_soup, html_text, write_image, write_project
 
-_PNG_BYTES = (
-    b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01"
-    b"\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89"
-    b"\x00\x00\x00\nIDATx\x9cc\xf8\x0f\x00\x01\x01\x01\x00"
-    b"\x18\xdd\x8d\xb0\x00\x00\x00\x00IEND\xaeB`\x82"
-)
+# Sphinx may suffix output image names when test builds share an image tree.
+_INCLUDEGRAPHICS_EXAMPLE_RE = re.compile(r"\\includegraphics\{example\d*\.png\}")
 
 
 @pytest.mark.sphinx("html")
@@ -241,12 +238,11 @@ def test_generated_ids_are_sanitized_for_unusual_docnames(tmp_path: Path) -> Non
     docname = 'bad" onclick="alert(1)'
     srcdir = tmp_path / "src"
     outdir = tmp_path / "out"
-    image_dir = srcdir / "images"
-    image_dir.mkdir(parents=True)
-    image_dir.joinpath("example.png").write_bytes(_PNG_BYTES)
-    srcdir.joinpath("conf.py").write_text(
-        textwrap.dedent(
-            f"""
+    write_project(
+        srcdir,
+        {
+            "images/example.png": _PNG_BYTES,
+            "conf.py": f"""
             import sys
 
             sys.path.insert(0, {str(Path.cwd())!r})
@@ -255,22 +251,16 @@ def test_generated_ids_are_sanitized_for_unusual_docnames(tmp_path: Path) -> Non
             project = "Security test"
             root_doc = {docname!r}
             html_static_path = []
-            """
-        ),
-        encoding="utf-8",
-    )
-    srcdir.joinpath(f"{docname}.rst").write_text(
-        textwrap.dedent(
-            """
+            """,
+            f"{docname}.rst": """
             Generated HTML
             ==============
 
             .. image:: images/example.png
                :alt: Example image.
                :class: lightbox
-            """
-        ),
-        encoding="utf-8",
+            """,
+        },
     )
 
     result = subprocess.run(
@@ -334,6 +324,25 @@ Unique generated ids
     } == set(checkbox_ids)
 
 
+@pytest.mark.sphinx("html")
+def test_legacy_directive_image_is_registered_by_sphinx_collector(app: SphinxTestApp) -> None:
+    write_image(app)
+    build_index(
+        app,
+        """
+Collected images
+================
+
+.. lightbox:: images/example.png
+   :alt: Compatibility lightbox.
+""",
+    )
+
+    assert app.env.images["images/example.png"][0] == {"index"}
+    image_src = html_soup(app).select_one(".lightbox-overlay img")["src"]
+    assert Path(app.outdir).joinpath(image_src).is_file()
+
+
 @pytest.mark.sphinx("html", confoverrides={"lightbox_all_images": True})
 def test_nested_document_writes_no_images_outside_outdir(app: SphinxTestApp) -> None:
     """A page nested several levels deep must not push images above outdir.
@@ -396,3 +405,51 @@ EPUB fallbacks
         "Standard EPUB image.",
         "Directive EPUB image.",
     }
+
+
+@pytest.mark.sphinx("text")
+def test_text_builder_writes_only_the_fallback_image(app: SphinxTestApp) -> None:
+    write_image(app)
+    build_index(
+        app,
+        """
+Text fallbacks
+==============
+
+.. lightbox:: images/example.png
+   :alt: Directive text image.
+   :caption: Not rendered as an overlay.
+""",
+    )
+
+    assert "[image: Directive text image.]" in Path(app.outdir).joinpath("index.txt").read_text(
+        encoding="utf-8"
+    )
+    doctree = app.env.get_doctree("index")
+    assert list(doctree.findall(LightboxContainer))
+    app.env.apply_post_transforms(doctree, "index")
+    assert not list(doctree.findall(LightboxContainer))
+
+
+@pytest.mark.sphinx("latex")
+def test_latex_builder_renders_legacy_directive_without_collector_visitor(
+    app: SphinxTestApp,
+) -> None:
+    write_image(app)
+    build_index(
+        app,
+        """
+LaTeX output
+============
+
+.. lightbox:: images/example.png
+   :alt: Directive LaTeX image.
+   :caption: LaTeX caption.
+""",
+    )
+
+    tex_files = list(Path(app.outdir).glob("*.tex"))
+    assert len(tex_files) == 1
+    tex = tex_files[0].read_text(encoding="utf-8")
+    assert _INCLUDEGRAPHICS_EXAMPLE_RE.search(tex)
+    assert r"\caption{LaTeX caption.}" in tex
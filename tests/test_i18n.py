@@ -3,14 +3,13 @@ from __future__ import annotations
 import gettext
 import subprocess
 import sys
-import textwrap
 from pathlib import Path
 from unittest.mock import Mock
 
 from bs4 import BeautifulSoup
 
 from lightbox.lightbox import setup
-from tests.helpers import _PNG_BYTES
+from tests.helpers import _PNG_BYTES, write_project
 
 _CATALOG = "sphinx-lightbox"
 _LOCALE_DIR = Path(__file__).resolve().parents[1] / "lightbox" / "locales"
@@ -89,13 +88,12 @@ def test_danish_catalog_translates_every_extension_message() -> None:
 def test_sphinx_danish_build_uses_bundled_catalog(tmp_path: Path) -> None:
     srcdir = tmp_path / "src"
     outdir = tmp_path / "out"
-    image_dir = srcdir / "images"
-    image_dir.mkdir(parents=True)
-    image_dir.joinpath("first.png").write_bytes(_PNG_BYTES)
-    image_dir.joinpath("second.png").write_bytes(_PNG_BYTES)
-    srcdir.joinpath("conf.py").write_text(
-        textwrap.dedent(
-            f"""
+    write_project(
+        srcdir,
+        {
+            "images/first.png": _PNG_BYTES,
+            "images/second.png": _PNG_BYTES,
+            "conf.py": f"""
             import sys
 
             sys.path.insert(0, {str(Path.cwd())!r})
@@ -105,13 +103,8 @@ def test_sphinx_danish_build_uses_bundled_catalog(tmp_path: Path) -> None:
             language = "da"
             html_static_path = []
             lightbox_gallery = "invalid"
-            """
-        ),
-        encoding="utf-8",
-    )
-    srcdir.joinpath("index.rst").write_text(
-        textwrap.dedent(
-            """
+            """,
+            "index.rst": """
             Dansk billedvisning
             ==================
 
@@ -122,9 +115,8 @@ def test_sphinx_danish_build_uses_bundled_catalog(tmp_path: Path) -> None:
             .. image:: images/second.png
                :alt: Andet motiv.
                :class: lightbox
-            """
-        ),
-        encoding="utf-8",
+            """,
+        },
     )
 
     result = subprocess.run(
@@ -5,10 +5,60 @@ Verifies that the JavaScript file is registered with Sphinx and contains
 the expected accessibility features (focus trap, Escape key, idempotency).
 """
 
-import os
+from pathlib import Path
 
 import pytest
 
+_JS_PATH = Path(__file__).resolve().parent.parent / "lightbox" / "static" / "lightbox.js"
+
+
+@pytest.fixture(scope="session")
+def js_source() -> str:
+    """Return lightbox.js, checked and read once per test session."""
+    # A missing file fails test_js_file_exists once; the content tests skip
+    # from this cached result instead of each repeating the same failure.
+    if not _JS_PATH.is_file():
+        pytest.skip(f"lightbox.js missing at {_JS_PATH}")
+    return _JS_PATH.read_text(encoding="utf-8")
+
+
+# Accessibility and gallery fragments that test_js_contains_token checks.
+_CONTENT_TOKENS = (
+    # Idempotency guard
+    "__sphinxLightboxInit",
+    # Focus trap
+    "getFocusableElements",
+    "e.shiftKey",
+    # Escape key handler
+    "Escape",
+    # Focus moves to the close button on open and back to the trigger on close
+    "_lastTrigger",
+    ".focus()",
+    # Gallery navigation helpers
+    "openLightboxById",
+    "getGalleryTargetId",
+    ".lightbox-gallery-control",
+    # Arrow-key gallery navigation
+    "ArrowLeft",
+    "ArrowRight",
+)
+
+# Every source fragment the content tests look for; the presence table below
+# is computed once per session and shared by those tests.
+_REQUIRED_TOKENS = (
+    "(function",
+    "dispatchEvent",
+    "new Event('change')",
+    'new Event("change")',
+    *_CONTENT_TOKENS,
+)
+
+
+@pytest.fixture(scope="session")
+def js_tokens(js_source: str) -> dict[str, bool]:
+    return {token: token in js_source for token in _REQUIRED_TOKENS}
+
+
 # ---------------------------------------------------------------------------
 # File existence and content
 # ---------------------------------------------------------------------------
@@ -17,72 +67,32 @@ import pytest
 class TestLightboxJsContent:
     """Verify lightbox.js exists and contains expected accessibility patterns."""
 
-    @staticmethod
-    def _read_js():
-        js_path = os.path.join(os.path.dirname(__file__), "..", "lightbox", "static", "lightbox.js")
-        with open(js_path) as f:
-            return f.read()
-
     @pytest.mark.unit
     def test_js_file_exists(self):
-        js_path = os.path.join(os.path.dirname(__file__), "..", "lightbox", "static", "lightbox.js")
-        assert os.path.isfile(js_path), "lightbox.js not found in static directory"
+        assert _JS_PATH.is_file(), "lightbox.js not found in static directory"
 
     @pytest.mark.unit
-    def test_js_is_syntactically_valid(self):
+    def test_js_is_syntactically_valid(self, js_source, js_tokens):
         """The file should be parseable (no obvious syntax errors).
 
         We cannot run a full JS parser in Python, but we verify the IIFE
         structure opens and closes correctly.
         """
-        source = self._read_js()
         # Contains an IIFE (may be preceded by a comment block)
-        assert "(function" in source, "Expected IIFE wrapper"
+        assert js_tokens["(function"], "Expected IIFE wrapper"
         # Ends with the IIFE invocation
-        assert source.strip().endswith("})();"), "Expected IIFE closing"
+        assert js_source.strip().endswith("})();"), "Expected IIFE closing"
 
     @pytest.mark.unit
-    def test_js_contains_idempotency_guard(self):
-        source = self._read_js()
-        assert "__sphinxLightboxInit" in source
+    @pytest.mark.parametrize("token", _CONTENT_TOKENS)
+    def test_js_contains_token(self, js_tokens, token):
+        assert js_tokens[token]
 
     @pytest.mark.unit
-    def test_js_contains_focus_trap(self):
-        source = self._read_js()
-        assert "getFocusableElements" in source
-        assert "e.shiftKey" in source
-
-    @pytest.mark.unit
-    def test_js_contains_escape_key_handler(self):
-        source = self._read_js()
-        assert "Escape" in source
-
-    @pytest.mark.unit
-    def test_js_contains_focus_management(self):
-        """Focus should move to close button on open, return to trigger on close."""
-        source = self._read_js()
-        assert "_lastTrigger" in source
-        assert ".focus()" in source
-
-    @pytest.mark.unit
-    def test_js_dispatches_change_event(self):
+    def test_js_dispatches_change_event(self, js_tokens):
         """Programmatic checkbox toggling must dispatch change for focus management."""
-        source = self._read_js()
-        assert "dispatchEvent" in source
-        assert "new Event('change')" in source or 'new Event("change")' in source
-
-    @pytest.mark.unit
-    def test_js_contains_gallery_navigation_helpers(self):
-        source = self._read_js()
-        assert "openLightboxById" in source
-        assert "getGalleryTargetId" in source
-        assert ".lightbox-gallery-control" in source
-
-    @pytest.mark.unit
-    def test_js_contains_arrow_key_gallery_navigation(self):
-        source = self._read_js()
-        assert "ArrowLeft" in source
-        assert "ArrowRight" in source
+        assert js_tokens["dispatchEvent"]
+        assert js_tokens["new Event('change')"] or js_tokens['new Event("change")']
 
 
 # ---------------------------------------------------------------------------
@@ -94,34 +104,16 @@ class TestJsRegistration:
     """Verify the extension registers lightbox.js with Sphinx."""
 
     @pytest.mark.unit
-    def test_setup_registers_js_file(self):
+    def test_setup_registers_js_file(self, configured_app):
         """setup() should call app.add_js_file('lightbox.js')."""
-        from unittest.mock import Mock
-
-        from lightbox.lightbox import setup
-
-        app = Mock()
-        app.config.html_static_path = []
-
-        setup(app)
-
         # Collect all add_js_file calls
-        js_calls = [call.args[0] for call in app.add_js_file.call_args_list]
+        js_calls = [call.args[0] for call in configured_app.add_js_file.call_args_list]
         assert "lightbox.js" in js_calls, "setup() must register lightbox.js via app.add_js_file"
 
     @pytest.mark.unit
-    def test_setup_registers_css_file(self):
+    def test_setup_registers_css_file(self, configured_app):
         """setup() should call app.add_css_file('lightbox.css')."""
-        from unittest.mock import Mock
-
-        from lightbox.lightbox import setup
-
-        app = Mock()
-        app.config.html_static_path = []
-
-        setup(app)
-
-        css_calls = [call.args[0] for call in app.add_css_file.call_args_list]
+        css_calls = [call.args[0] for call in configured_app.add_css_file.call_args_list]
         assert "lightbox.css" in css_calls, (
             "setup() must register lightbox.css via app.add_css_file"
         )
@@ -5,64 +5,143 @@ Covers LaTeX and HTML output generation, directive parsing, security,
 and build-time aspect ratio calculations.
 """
 
+import os
+import re
+import string
+from html import escape as html_escape
+from html.parser import HTMLParser
+from importlib.metadata import version
+from types import MappingProxyType, SimpleNamespace
 from unittest.mock import Mock, patch
 
 import pytest
 from docutils import nodes
+from sphinx.application import Sphinx
 from sphinx.util.texescape import escape as latex_escape
 
 from lightbox.lightbox import (
+    LightboxCollector,
     LightboxContainer,
     LightboxDirective,
     LightboxOverlay,
     LightboxTrigger,
+    __version__,
+    _builder_inited,
+    _cached_latex_escape,
+    _copy_missing_lightbox_images,
+    _esc_attr,
+    _escape_latex_caption,
+    _image_size,
+    _merge_lightbox_images,
+    _missing_html_image_targets,
+    _purge_lightbox_images,
+    _register_lightbox_image,
+    _resolve_cached,
+    _resolve_output_uri,
     assign_lightbox_gallery,
+    depart_lightbox_container_html,
+    depart_lightbox_overlay_html,
+    depart_lightbox_trigger_html,
+    setup,
     transform_lightbox_images,
+    visit_lightbox_container_html,
     visit_lightbox_container_latex,
+    visit_lightbox_overlay_html,
+    visit_lightbox_trigger_html,
 )
+from tests.helpers import StubBuilder, child_of_type
+
+# Empty directive options shared read-only across tests; the directive never mutates them.
+_NO_OPTIONS = MappingProxyType({})
+
+# Expected \adjustbox width arguments, rendered once per latex_width fraction.
+_MAXWIDTH = {
+    f: rf"\adjustbox{{max width={f}\linewidth}}" for f in ("0.00", "0.75", "0.90", "0.95", "1.00")
+}
+
+# The \caption{...} argument, and a % that LaTeX would read as a comment.
+_CAPTION_RE = re.compile(r"\\caption\{([^}]+)\}")
+_BARE_PCT_RE = re.compile(r"(?<!\\)%")
+
+# Node attributes for HTML visitor tests. Apart from uri and checkbox_id these
+# equal the defaults the visitors fall back to when an attribute is missing.
+_TRIGGER_DEFAULTS = MappingProxyType(
+    {"uri": "i.png", "checkbox_id": "l1", "alt": "", "thumbnail_width": "100%", "custom_class": ""}
+)
+_OVERLAY_DEFAULTS = MappingProxyType(
+    {"uri": "i.png", "checkbox_id": "l1", "alt": "", "caption": "", "custom_class": ""}
+)
+
+# Entities produced by _esc_attr(); the markup templates themselves use none.
+_HTML_ENTITY_RE = re.compile(r"&(?:quot|lt|gt|amp|#x27);")
 
 # ---------------------------------------------------------------------------
-# Helper: call the LaTeX visitor and absorb the expected SkipNode signal
+# Helpers: build nodes for the visitor tests, and run the LaTeX visitor while
+# absorbing the expected SkipNode signal
 # ---------------------------------------------------------------------------
 
 
+def latex_container(uri="/images/test.png", caption="", latex_width="0.95"):
+    return LightboxContainer(uri=uri, caption=caption, latex_width=latex_width)
+
+
+def trigger_node(**attributes):
+    """Return a trigger node; omitted attributes take the visitor's own fallbacks."""
+    return LightboxTrigger(**{**_TRIGGER_DEFAULTS, **attributes})
+
+
+def overlay_node(**attributes):
+    """Return an overlay node; omitted attributes take the visitor's own fallbacks."""
+    return LightboxOverlay(**{**_OVERLAY_DEFAULTS, **attributes})
+
+
 def run_latex_visitor(translator, node):
     with pytest.raises(nodes.SkipNode):
         visit_lightbox_container_latex(translator, node)
 
 
 # ---------------------------------------------------------------------------
-# TestCaptionEscaping
+# Caption escaping
 # ---------------------------------------------------------------------------
 
 
-class TestCaptionEscaping:
-    """Test LaTeX special-character escaping in captions."""
+@pytest.mark.latex
+@pytest.mark.unit
+@pytest.mark.parametrize(
+    ("raw", "needle"),
+    [
+        ("40% width", r"\%"),
+        ("A & B", r"\&"),
+        ("file_name", r"\_"),
+        ("Cost: $100", r"\$"),
+        ("Issue #42", r"\#"),
+    ],
+)
+def test_single_char_escaped(raw, needle):
+    assert needle in latex_escape(raw)
 
-    @pytest.mark.unit
-    def test_percent_sign_escaped(self):
-        assert r"\%" in latex_escape("40% width")
 
-    @pytest.mark.unit
-    def test_ampersand_escaped(self):
-        assert r"\&" in latex_escape("A & B")
+@pytest.mark.latex
+@pytest.mark.unit
+def test_multiple_special_chars_escaped():
+    escaped = latex_escape("40% width & special: $_#")
+    assert all(c in escaped for c in [r"\%", r"\&", r"\$", r"\_", r"\#"])
 
-    @pytest.mark.unit
-    def test_underscore_escaped(self):
-        assert r"\_" in latex_escape("file_name")
 
-    @pytest.mark.unit
-    def test_dollar_sign_escaped(self):
-        assert r"\$" in latex_escape("Cost: $100")
+@pytest.mark.latex
+@pytest.mark.unit
+def test_caption_fast_path_agrees_with_latex_escape():
+    for char in string.printable:
+        for latex_engine in (None, "xelatex"):
+            expected = latex_escape(f"a{char}b", latex_engine)
+            assert _escape_latex_caption(f"a{char}b", latex_engine) == expected
 
-    @pytest.mark.unit
-    def test_hash_escaped(self):
-        assert r"\#" in latex_escape("Issue #42")
 
-    @pytest.mark.unit
-    def test_multiple_special_chars_escaped(self):
-        escaped = latex_escape("40% width & special: $_#")
-        assert all(c in escaped for c in [r"\%", r"\&", r"\$", r"\_", r"\#"])
+@pytest.mark.latex
+@pytest.mark.unit
+def test_plain_caption_skips_escape_cache():
+    assert _escape_latex_caption("A plain caption.", None) == "A plain caption."
+    assert _cached_latex_escape.cache_info().currsize == 0
 
 
 # ---------------------------------------------------------------------------
@@ -73,66 +152,71 @@ class TestCaptionEscaping:
 class TestLatexOutput:
     """Test LaTeX code generation via the visitor function."""
 
-    @pytest.mark.integration
-    def test_uses_adjustbox_max_width(self, mock_builder):
-        node = LightboxContainer()
-        node["uri"] = "/images/test.png"
-        node["caption"] = ""
-        node["latex_width"] = "0.90"
+    pytestmark = [pytest.mark.integration, pytest.mark.latex]
+
+    @pytest.mark.parametrize("latex_width", sorted(_MAXWIDTH))
+    def test_latex_width_emitted_as_adjustbox_max_width(self, mock_builder, latex_width):
+        node = latex_container(latex_width=latex_width)
         run_latex_visitor(mock_builder.translator, node)
-        assert r"\adjustbox{max width=0.90\linewidth}" in "".join(mock_builder.translator.body)
+        assert _MAXWIDTH[latex_width] in mock_builder.translator.rendered()
 
-    @pytest.mark.integration
     def test_includes_figure_environment(self, mock_builder):
-        node = LightboxContainer()
-        node["uri"] = "/images/test.png"
-        node["caption"] = ""
-        node["latex_width"] = "0.95"
+        node = latex_container()
         run_latex_visitor(mock_builder.translator, node)
-        output = "".join(mock_builder.translator.body)
+        output = mock_builder.translator.rendered()
         assert r"\begin{figure}[htbp]" in output
         assert r"\centering" in output
         assert r"\end{figure}" in output
 
-    @pytest.mark.integration
     def test_caption_properly_escaped(self, mock_builder):
-        node = LightboxContainer()
-        node["uri"] = "/images/test.png"
-        node["caption"] = "40% width & more"
-        node["latex_width"] = "0.95"
+        node = latex_container(caption="40% width & more")
+        run_latex_visitor(mock_builder.translator, node)
+        output = mock_builder.translator.rendered()
+        assert r"\caption{40\% width \& more}" in output
+        # An unescaped % would comment out the closing brace of \caption{...}.
+        caption = _CAPTION_RE.search(output)
+        assert caption is not None
+        assert _BARE_PCT_RE.search(caption.group(1)) is None
+
+    def test_repeated_caption_is_escaped_once(self, mock_builder):
+        for _ in range(3):
+            node = latex_container(caption="Shared & caption")
+            run_latex_visitor(mock_builder.translator, node)
+        assert _cached_latex_escape.cache_info().hits == 2
+        assert mock_builder.translator.rendered().count(r"\caption{Shared \& caption}") == 3
+
+    @pytest.mark.parametrize(
+        ("latex_engine", "expected"),
+        [
+            ("pdflatex", r"\caption{It\textquotesingle{}s 5\texteuro{}}"),
+            ("xelatex", r"\caption{It's 5€}"),
+            ("lualatex", r"\caption{It's 5€}"),
+        ],
+    )
+    def test_caption_escaped_for_configured_engine(self, mock_builder, latex_engine, expected):
+        mock_builder.config = SimpleNamespace(latex_engine=latex_engine)
+        node = latex_container(caption="It's 5€")
         run_latex_visitor(mock_builder.translator, node)
-        assert r"\caption{40\% width \& more}" in "".join(mock_builder.translator.body)
+        assert expected in mock_builder.translator.rendered()
 
-    @pytest.mark.integration
-    def test_no_caption_omits_caption_command(self, mock_builder):
-        node = LightboxContainer()
-        node["uri"] = "/images/test.png"
-        node["caption"] = ""
-        node["latex_width"] = "0.95"
+    def test_figure_is_appended_to_body_once(self, mock_builder):
+        node = latex_container(caption="Caption")
         run_latex_visitor(mock_builder.translator, node)
-        assert r"\caption" not in "".join(mock_builder.translator.body)
+        assert len(mock_builder.translator.body) == 1
 
-    @pytest.mark.integration
-    def test_latex_width_percentage_conversion(self, mock_builder):
-        node = LightboxContainer()
-        node["uri"] = "/images/test.png"
-        node["caption"] = ""
-        node["latex_width"] = "0.75"
+    def test_no_caption_omits_caption_command(self, mock_builder):
+        node = latex_container()
         run_latex_visitor(mock_builder.translator, node)
-        assert r"max width=0.75\linewidth" in "".join(mock_builder.translator.body)
+        assert r"\caption" not in mock_builder.translator.rendered()
 
-    @pytest.mark.integration
     def test_image_file_from_builder(self, mock_builder):
         uri = "/images/test.png"
         mock_builder.images = {uri: "test-abc123.png"}
-        node = LightboxContainer()
-        node["uri"] = uri
-        node["caption"] = ""
-        node["latex_width"] = "0.95"
+        node = latex_container(uri=uri)
         translator = mock_builder.translator
         translator.builder = mock_builder
         run_latex_visitor(translator, node)
-        assert r"\includegraphics{test-abc123.png}" in "".join(translator.body)
+        assert r"\includegraphics{test-abc123.png}" in translator.rendered()
 
 
 # ---------------------------------------------------------------------------
@@ -143,85 +227,72 @@ class TestLatexOutput:
 class TestLegacyLatexWidthOption:
     """Test the legacy directive's retained PDF width compatibility option."""
 
-    def _make_directive(self, sphinx_env, arguments, options):
-        state = Mock()
-        state.document.settings.env = sphinx_env
-        state_machine = Mock()
-        state_machine.get_source_and_line.return_value = ("test.rst", 10)
+    pytestmark = pytest.mark.unit
+
+    def _make_directive(self, directive_state, arguments, options):
+        state, state_machine = directive_state
         return LightboxDirective("lightbox", arguments, options, [], 1, 0, "", state, state_machine)
 
-    @pytest.mark.unit
-    def test_latex_width_overrides_percentage(self, sphinx_env):
+    def test_latex_width_overrides_percentage(self, directive_state, isfile_true):
         """Explicit :latex-width: should override the percentage-derived value."""
         directive = self._make_directive(
-            sphinx_env, ["/i.png"], {"percentage": [50, 90], "latex-width": "0.80"}
+            directive_state,
+            ["/i.png"],
+            {"percentage": [50, 90], "latex-width": "0.80"},
         )
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
+        res = directive.run()
         assert res[0]["latex_width"] == "0.80"
 
-    @pytest.mark.unit
-    def test_latex_width_without_percentage(self, sphinx_env):
+    def test_latex_width_without_percentage(self, directive_state, isfile_true):
         """:latex-width: should work even when :percentage: is not set."""
-        directive = self._make_directive(sphinx_env, ["/i.png"], {"latex-width": "0.60"})
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
+        directive = self._make_directive(directive_state, ["/i.png"], {"latex-width": "0.60"})
+        res = directive.run()
         assert res[0]["latex_width"] == "0.60"
 
-    @pytest.mark.unit
-    def test_absent_latex_width_falls_back_to_percentage(self, sphinx_env):
+    def test_absent_latex_width_falls_back_to_percentage(self, directive_state, isfile_true):
         """Without :latex-width:, the second percentage value is used."""
-        directive = self._make_directive(sphinx_env, ["/i.png"], {"percentage": [50, 75]})
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
+        directive = self._make_directive(directive_state, ["/i.png"], {"percentage": [50, 75]})
+        res = directive.run()
         assert res[0]["latex_width"] == "0.75"
 
-    @pytest.mark.unit
-    def test_absent_latex_width_falls_back_to_default_95(self, sphinx_env):
+    def test_absent_latex_width_falls_back_to_default_95(self, directive_state, isfile_true):
         """Without :latex-width: or :percentage:, the default 0.95 is used."""
-        directive = self._make_directive(sphinx_env, ["/i.png"], {})
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
+        directive = self._make_directive(directive_state, ["/i.png"], _NO_OPTIONS)
+        res = directive.run()
         assert res[0]["latex_width"] == "0.95"
 
-    @pytest.mark.unit
-    def test_invalid_latex_width_emits_warning_and_falls_back(self, sphinx_env):
+    def test_invalid_latex_width_emits_warning_and_falls_back(self, directive_state, isfile_true):
         """Invalid values should warn and keep the percentage-based default."""
         directive = self._make_directive(
-            sphinx_env, ["/i.png"], {"percentage": [50, 90], "latex-width": "abc"}
+            directive_state,
+            ["/i.png"],
+            {"percentage": [50, 90], "latex-width": "abc"},
         )
-        with (
-            patch("lightbox.lightbox.os.path.isfile", return_value=True),
-            patch("lightbox.lightbox.logger") as mock_logger,
-        ):
+        with patch("lightbox.lightbox.logger") as mock_logger:
             res = directive.run()
         # Falls back to percentage-derived value
         assert res[0]["latex_width"] == "0.90"
         assert mock_logger.warning.called
         assert mock_logger.warning.call_args.kwargs.get("subtype") == "invalid_option"
 
-    @pytest.mark.unit
-    def test_out_of_range_latex_width_emits_warning(self, sphinx_env):
+    def test_out_of_range_latex_width_emits_warning(self, directive_state, isfile_true):
         """Values outside (0, 1] should warn and keep the default."""
-        directive = self._make_directive(sphinx_env, ["/i.png"], {"latex-width": "1.5"})
-        with (
-            patch("lightbox.lightbox.os.path.isfile", return_value=True),
-            patch("lightbox.lightbox.logger") as mock_logger,
-        ):
+        directive = self._make_directive(directive_state, ["/i.png"], {"latex-width": "1.5"})
+        with patch("lightbox.lightbox.logger") as mock_logger:
             res = directive.run()
         # Falls back to default 95%
         assert res[0]["latex_width"] == "0.95"
         assert mock_logger.warning.called
 
-    @pytest.mark.unit
-    def test_latex_width_does_not_affect_html_size_style(self, sphinx_env):
+    def test_latex_width_does_not_affect_html_size_style(self, directive_state, isfile_true):
         """:latex-width: must not change the CSS size_style on the overlay."""
         directive = self._make_directive(
-            sphinx_env, ["/i.png"], {"percentage": [50, 90], "latex-width": "0.60"}
+            directive_state,
+            ["/i.png"],
+            {"percentage": [50, 90], "latex-width": "0.60"},
         )
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
-        overlay = next(n for n in res[0].children if isinstance(n, LightboxOverlay))
+        res = directive.run()
+        overlay = child_of_type(res[0], LightboxOverlay)
         # CSS should still use the percentage value (90), not the latex-width
         assert "min(90vw," in overlay["size_style"]
 
@@ -234,80 +305,89 @@ class TestLegacyLatexWidthOption:
 class TestDirectiveIntegration:
     """Test the full directive workflow."""
 
-    def _make_directive(self, sphinx_env, arguments, options):
-        state = Mock()
-        state.document.settings.env = sphinx_env
-        state_machine = Mock()
-        state_machine.get_source_and_line.return_value = ("test.rst", 10)
+    def _make_directive(self, directive_state, arguments, options):
+        state, state_machine = directive_state
         return LightboxDirective("lightbox", arguments, options, [], 1, 0, "", state, state_machine)
 
     @pytest.mark.integration
-    def test_hidden_collector_has_leading_slash(self, sphinx_env):
-        directive = self._make_directive(sphinx_env, ["images/test.png"], {})
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            result_nodes = directive.run()
-        collector = next(
-            n for n in result_nodes[0].children if n.__class__.__name__ == "LightboxCollector"
-        )
+    def test_hidden_collector_has_leading_slash(self, directive_state, isfile_true):
+        directive = self._make_directive(directive_state, ["images/test.png"], _NO_OPTIONS)
+        result_nodes = directive.run()
+        collector = child_of_type(result_nodes[0], LightboxCollector)
         assert collector.children[0]["uri"] == "/images/test.png"
 
     @pytest.mark.integration
-    def test_percentage_option_converts_to_latex_width(self, sphinx_env):
-        directive = self._make_directive(sphinx_env, ["/i.png"], {"percentage": [50, 90]})
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
+    def test_percentage_option_converts_to_latex_width(self, directive_state, isfile_true):
+        directive = self._make_directive(directive_state, ["/i.png"], {"percentage": [50, 90]})
+        res = directive.run()
         assert res[0]["latex_width"] == "0.90"
 
     @pytest.mark.integration
-    def test_default_percentage_is_95(self, sphinx_env):
-        directive = self._make_directive(sphinx_env, ["/i.png"], {})
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
+    def test_default_percentage_is_95(self, directive_state, isfile_true):
+        directive = self._make_directive(directive_state, ["/i.png"], _NO_OPTIONS)
+        res = directive.run()
         assert res[0]["latex_width"] == "0.95"
 
     @pytest.mark.unit
-    def test_external_uri_returns_standard_image(self, sphinx_env):
-        directive = self._make_directive(sphinx_env, ["https://ex.com/p.png"], {"alt": "Ext"})
+    def test_external_uri_returns_standard_image(self, directive_state):
+        directive = self._make_directive(directive_state, ["https://ex.com/p.png"], {"alt": "Ext"})
         res = directive.run()
         assert isinstance(res[0], nodes.image)
         assert res[0]["uri"] == "https://ex.com/p.png"
 
     @pytest.mark.integration
-    def test_checkbox_id_includes_docname_for_singlehtml_safety(self, sphinx_env):
+    def test_checkbox_id_includes_docname_for_singlehtml_safety(
+        self, sphinx_env, directive_state, isfile_true
+    ):
         sphinx_env.docname = "nested/page"
-        directive = self._make_directive(sphinx_env, ["/i.png"], {})
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
-        trigger = next(n for n in res[0].children if isinstance(n, LightboxTrigger))
+        directive = self._make_directive(directive_state, ["/i.png"], _NO_OPTIONS)
+        res = directive.run()
+        trigger = child_of_type(res[0], LightboxTrigger)
         assert trigger["checkbox_id"] == "lightbox-nested-page-1"
 
     @pytest.mark.integration
-    def test_checkbox_id_sanitizes_docname_for_html_id_safety(self, sphinx_env):
+    def test_checkbox_id_sanitizes_docname_for_html_id_safety(
+        self, sphinx_env, directive_state, isfile_true
+    ):
         sphinx_env.docname = 'nested/page with "quotes"'
-        directive = self._make_directive(sphinx_env, ["/i.png"], {})
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
-        trigger = next(n for n in res[0].children if isinstance(n, LightboxTrigger))
+        directive = self._make_directive(directive_state, ["/i.png"], _NO_OPTIONS)
+        res = directive.run()
+        trigger = child_of_type(res[0], LightboxTrigger)
         assert trigger["checkbox_id"] == "lightbox-nested-page-with-quotes-1"
 
     @pytest.mark.unit
-    def test_data_uri_returns_standard_image(self, sphinx_env):
+    def test_data_uri_returns_standard_image(self, directive_state):
         data_uri = "data:image/png;base64,AAAA"
-        directive = self._make_directive(sphinx_env, [data_uri], {"alt": "Inline"})
+        directive = self._make_directive(directive_state, [data_uri], {"alt": "Inline"})
         res = directive.run()
         assert isinstance(res[0], nodes.image)
         assert res[0]["uri"] == data_uri
 
     @pytest.mark.integration
-    def test_collector_image_remains_visible_to_fallback_builders(self, sphinx_env):
-        directive = self._make_directive(sphinx_env, ["images/test.png"], {})
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            result_nodes = directive.run()
-        collector = next(
-            n for n in result_nodes[0].children if n.__class__.__name__ == "LightboxCollector"
-        )
+    def test_collector_image_remains_visible_to_fallback_builders(
+        self, directive_state, isfile_true
+    ):
+        directive = self._make_directive(directive_state, ["images/test.png"], _NO_OPTIONS)
+        result_nodes = directive.run()
+        collector = child_of_type(result_nodes[0], LightboxCollector)
         assert collector.children[0]["classes"] == []
 
+    @pytest.mark.integration
+    def test_static_image_attributes_are_rendered_at_parse_time(self, directive_state, isfile_true):
+        directive = self._make_directive(
+            directive_state, ["/i.png"], {"class": 'a"b', "percentage": [40, 90]}
+        )
+        res = directive.run()
+        trigger = child_of_type(res[0], LightboxTrigger)
+        overlay = child_of_type(res[0], LightboxOverlay)
+        assert trigger["img_attrs"] == ' class="lightbox-trigger a&quot;b" style="width: 40%;"'
+        assert overlay["img_attrs"].startswith(' class="a&quot;b" style="width: min(90vw,')
+
+        trigger["img_attrs"] = ' class="precomputed"'
+        t = StubBuilder().translator
+        visit_lightbox_trigger_html(t, trigger)
+        assert '<img src="i.png" alt="" class="precomputed">' in t.rendered()
+
 
 # ---------------------------------------------------------------------------
 # TestStandardImageTransform
@@ -317,6 +397,8 @@ class TestDirectiveIntegration:
 class TestStandardImageTransform:
     """Test class-based lightbox wrapping for normal image and figure nodes."""
 
+    pytestmark = pytest.mark.unit
+
     @staticmethod
     def _make_app(
         builder_format="html",
@@ -346,7 +428,6 @@ class TestStandardImageTransform:
         doc += list(children)
         return doc
 
-    @pytest.mark.unit
     def test_image_with_lightbox_class_is_transformed(self):
         image = nodes.image(uri="sample.png", alt="Sample", classes=["lightbox"])
         doc = self._make_doc(image)
@@ -360,7 +441,6 @@ class TestStandardImageTransform:
         assert doc[0][0]["checkbox_id"] == "lightbox-index-1"
         app.env.new_serialno.assert_not_called()
 
-    @pytest.mark.unit
     def test_transform_is_idempotent_when_all_images_are_enabled(self):
         image = nodes.image(uri="sample.png", alt="Sample")
         doc = self._make_doc(image)
@@ -372,7 +452,6 @@ class TestStandardImageTransform:
         assert len(list(doc.findall(LightboxContainer))) == 1
         assert len(list(doc.findall(LightboxOverlay))) == 1
 
-    @pytest.mark.unit
     def test_standard_ids_do_not_collide_with_legacy_containers(self):
         legacy = LightboxContainer()
         legacy_trigger = LightboxTrigger(checkbox_id="lightbox-index-1")
@@ -386,7 +465,6 @@ class TestStandardImageTransform:
 
         assert doc[1][0]["checkbox_id"] == "lightbox-index-2"
 
-    @pytest.mark.unit
     def test_checkbox_id_does_not_collide_with_native_named_image(self):
         image = nodes.image(
             uri="sample.png",
@@ -397,12 +475,11 @@ class TestStandardImageTransform:
 
         transform_lightbox_images(self._make_app(), doc, "index")
 
-        trigger = next(child for child in doc[0] if isinstance(child, LightboxTrigger))
-        thumbnail = next(child for child in trigger if isinstance(child, nodes.image))
+        trigger = child_of_type(doc[0], LightboxTrigger)
+        thumbnail = child_of_type(trigger, nodes.image)
         assert trigger["checkbox_id"] == "lightbox-index-2"
         assert thumbnail["ids"] == ["lightbox-index-1"]
 
-    @pytest.mark.unit
     def test_legacy_checkbox_id_is_renamed_when_native_id_collides(self):
         legacy = LightboxContainer()
         legacy_trigger = LightboxTrigger(checkbox_id="lightbox-index-1")
@@ -418,12 +495,11 @@ class TestStandardImageTransform:
 
         transform_lightbox_images(self._make_app(), doc, "index")
 
-        standard_trigger = next(child for child in doc[1] if isinstance(child, LightboxTrigger))
+        standard_trigger = child_of_type(doc[1], LightboxTrigger)
         assert legacy_trigger["checkbox_id"] == "lightbox-index-2"
         assert legacy_overlay["checkbox_id"] == "lightbox-index-2"
         assert standard_trigger["checkbox_id"] == "lightbox-index-3"
 
-    @pytest.mark.unit
     def test_remote_image_with_lightbox_class_is_not_transformed(self):
         image = nodes.image(uri="https://example.invalid/sample.png", classes=["lightbox"])
         doc = self._make_doc(image)
@@ -432,7 +508,6 @@ class TestStandardImageTransform:
 
         assert isinstance(doc[0], nodes.image)
 
-    @pytest.mark.unit
     def test_data_image_with_lightbox_class_is_not_transformed(self):
         image = nodes.image(uri="data:image/png;base64,AAAA", classes=["lightbox"])
         doc = self._make_doc(image)
@@ -441,19 +516,17 @@ class TestStandardImageTransform:
 
         assert isinstance(doc[0], nodes.image)
 
-    @pytest.mark.unit
     def test_transformed_image_keeps_native_thumbnail_for_asset_copying(self):
         image = nodes.image(uri="images/sample.png", alt="Sample", classes=["lightbox"])
         doc = self._make_doc(image)
 
         transform_lightbox_images(self._make_app(), doc, "index")
 
-        trigger = next(child for child in doc[0] if isinstance(child, LightboxTrigger))
-        thumbnail = next(child for child in trigger if isinstance(child, nodes.image))
+        trigger = child_of_type(doc[0], LightboxTrigger)
+        thumbnail = child_of_type(trigger, nodes.image)
         assert thumbnail["uri"] == "images/sample.png"
         assert thumbnail["alt"] == ""
 
-    @pytest.mark.unit
     def test_image_without_lightbox_class_is_left_alone(self):
         image = nodes.image(uri="sample.png", alt="Sample")
         doc = self._make_doc(image)
@@ -462,7 +535,6 @@ class TestStandardImageTransform:
 
         assert isinstance(doc[0], nodes.image)
 
-    @pytest.mark.unit
     def test_global_enable_wraps_plain_images(self):
         image = nodes.image(uri="sample.png", alt="Sample")
         doc = self._make_doc(image)
@@ -471,7 +543,6 @@ class TestStandardImageTransform:
 
         assert isinstance(doc[0], LightboxContainer)
 
-    @pytest.mark.unit
     def test_no_lightbox_class_opts_out_of_global_enable(self):
         image = nodes.image(uri="sample.png", classes=["no-lightbox"])
         doc = self._make_doc(image)
@@ -480,7 +551,6 @@ class TestStandardImageTransform:
 
         assert isinstance(doc[0], nodes.image)
 
-    @pytest.mark.unit
     def test_non_html_builds_do_not_transform_images(self):
         image = nodes.image(uri="sample.png", classes=["lightbox"])
         doc = self._make_doc(image)
@@ -489,7 +559,6 @@ class TestStandardImageTransform:
 
         assert isinstance(doc[0], nodes.image)
 
-    @pytest.mark.unit
     def test_epub_builds_do_not_transform_images(self):
         image = nodes.image(uri="sample.png", classes=["lightbox"])
         doc = self._make_doc(image)
@@ -500,7 +569,6 @@ class TestStandardImageTransform:
 
         assert isinstance(doc[0], nodes.image)
 
-    @pytest.mark.unit
     def test_figure_caption_is_copied_to_lightbox_overlay(self):
         image = nodes.image(uri="sample.png")
         caption = nodes.caption("", "Figure caption.")
@@ -510,11 +578,10 @@ class TestStandardImageTransform:
         transform_lightbox_images(self._make_app(), doc, "index")
 
         container = figure[0]
-        overlay = next(child for child in container if isinstance(child, LightboxOverlay))
+        overlay = child_of_type(container, LightboxOverlay)
         assert overlay["caption"] == "Figure caption."
         assert figure[1].astext() == "Figure caption."
 
-    @pytest.mark.unit
     def test_figure_legend_is_copied_to_lightbox_overlay(self):
         image = nodes.image(uri="sample.png")
         caption = nodes.caption("", "Figure caption.")
@@ -525,22 +592,29 @@ class TestStandardImageTransform:
         transform_lightbox_images(self._make_app(), doc, "index")
 
         container = figure[0]
-        overlay = next(child for child in container if isinstance(child, LightboxOverlay))
+        overlay = child_of_type(container, LightboxOverlay)
         assert overlay["legend"] == "Longer explanation."
         assert figure[2].astext() == "Longer explanation."
 
-    @pytest.mark.unit
+    def test_transformed_overlay_does_not_store_empty_size_style(self):
+        image = nodes.image(uri="sample.png", classes=["lightbox"])
+        doc = self._make_doc(image)
+
+        transform_lightbox_images(self._make_app(), doc, "index")
+
+        overlay = child_of_type(doc[0], LightboxOverlay)
+        assert "size_style" not in overlay.attributes
+
     def test_plain_images_do_not_use_alt_as_caption(self):
         image = nodes.image(uri="sample.png", alt="Not a caption", classes=["lightbox"])
         doc = self._make_doc(image)
 
         transform_lightbox_images(self._make_app(), doc, "index")
 
-        overlay = next(child for child in doc[0] if isinstance(child, LightboxOverlay))
+        overlay = child_of_type(doc[0], LightboxOverlay)
         assert overlay["caption"] == ""
         assert overlay["legend"] == ""
 
-    @pytest.mark.unit
     def test_figure_policy_none_disables_implicit_figure_wrapping(self):
         image = nodes.image(uri="sample.png")
         figure = nodes.figure("", image, nodes.caption("", "Caption."))
@@ -550,7 +624,6 @@ class TestStandardImageTransform:
 
         assert isinstance(figure[0], nodes.image)
 
-    @pytest.mark.unit
     def test_figure_policy_explicit_requires_lightbox_class(self):
         image = nodes.image(uri="sample.png")
         figure = nodes.figure("", image, nodes.caption("", "Caption."))
@@ -560,7 +633,6 @@ class TestStandardImageTransform:
 
         assert isinstance(figure[0], nodes.image)
 
-    @pytest.mark.unit
     def test_all_images_switch_still_wraps_plain_images(self):
         image = nodes.image(uri="sample.png")
         doc = self._make_doc(image)
@@ -569,7 +641,6 @@ class TestStandardImageTransform:
 
         assert isinstance(doc[0], LightboxContainer)
 
-    @pytest.mark.unit
     def test_default_class_is_applied_to_transformed_images(self):
         image = nodes.image(uri="sample.png", classes=["lightbox"])
         doc = self._make_doc(image)
@@ -579,7 +650,6 @@ class TestStandardImageTransform:
         trigger = doc[0][0]
         assert trigger["custom_class"] == "with-shadow"
 
-    @pytest.mark.unit
     def test_user_classes_are_preserved_without_control_class(self):
         image = nodes.image(uri="sample.png", classes=["lightbox", "with-border"])
         doc = self._make_doc(image)
@@ -589,7 +659,6 @@ class TestStandardImageTransform:
         trigger = doc[0][0]
         assert trigger["custom_class"] == "with-border"
 
-    @pytest.mark.unit
     def test_native_thumbnail_preserves_image_options(self):
         image = nodes.image(
             uri="sample.png",
@@ -605,8 +674,8 @@ class TestStandardImageTransform:
 
         transform_lightbox_images(self._make_app(), doc, "index")
 
-        trigger = next(child for child in doc[0] if isinstance(child, LightboxTrigger))
-        thumbnail = next(child for child in trigger if isinstance(child, nodes.image))
+        trigger = child_of_type(doc[0], LightboxTrigger)
+        thumbnail = child_of_type(trigger, nodes.image)
         assert thumbnail["alt"] == ""
         assert thumbnail["width"] == "45%"
         assert thumbnail["height"] == "120px"
@@ -615,7 +684,6 @@ class TestStandardImageTransform:
         assert thumbnail["ids"] == ["named-image"]
         assert thumbnail["classes"] == ["lightbox-trigger", "no-scaled-link", "custom"]
 
-    @pytest.mark.unit
     def test_image_alignment_is_preserved_on_container(self):
         image = nodes.image(uri="sample.png", classes=["lightbox"], align="center")
         doc = self._make_doc(image)
@@ -633,6 +701,8 @@ class TestStandardImageTransform:
 class TestGalleryMetadata:
     """Test source-order gallery metadata for transformed lightboxes."""
 
+    pytestmark = pytest.mark.unit
+
     @staticmethod
     def _make_app(gallery_mode="document", gallery_wrap=False):
         app = Mock()
@@ -657,7 +727,6 @@ class TestGalleryMetadata:
         doc += list(children)
         return doc
 
-    @pytest.mark.unit
     def test_gallery_metadata_assigned_in_source_order(self):
         first, first_overlay = self._make_container("lb-1")
         second, second_overlay = self._make_container("lb-2")
@@ -676,7 +745,6 @@ class TestGalleryMetadata:
         assert third_overlay["gallery_prev_target"] == "lb-2"
         assert "gallery_next_target" not in third_overlay
 
-    @pytest.mark.unit
     def test_gallery_id_sanitizes_docname(self):
         first, first_overlay = self._make_container("lb-1")
         second, _second_overlay = self._make_container("lb-2")
@@ -686,7 +754,6 @@ class TestGalleryMetadata:
 
         assert first_overlay["gallery_id"] == "lightbox-gallery-nested-page-with-quotes"
 
-    @pytest.mark.unit
     def test_gallery_wrap_cycles_first_and_last_items(self):
         first, first_overlay = self._make_container("lb-1")
         second, second_overlay = self._make_container("lb-2")
@@ -697,7 +764,6 @@ class TestGalleryMetadata:
         assert first_overlay["gallery_prev_target"] == "lb-2"
         assert second_overlay["gallery_next_target"] == "lb-1"
 
-    @pytest.mark.unit
     def test_gallery_none_suppresses_metadata(self):
         first, first_overlay = self._make_container("lb-1")
         second, second_overlay = self._make_container("lb-2")
@@ -708,7 +774,6 @@ class TestGalleryMetadata:
         assert "gallery_next_target" not in first_overlay
         assert "gallery_prev_target" not in second_overlay
 
-    @pytest.mark.unit
     def test_single_item_document_suppresses_metadata(self):
         container, overlay = self._make_container("lb-1")
         doc = self._make_doc(container)
@@ -718,7 +783,6 @@ class TestGalleryMetadata:
         assert "gallery_index" not in overlay
         assert "gallery_next_target" not in overlay
 
-    @pytest.mark.unit
     def test_transformed_images_get_gallery_metadata(self):
         app = TestStandardImageTransform._make_app(image_policy="all")
         first = nodes.image(uri="first.png", alt="First")
@@ -727,8 +791,8 @@ class TestGalleryMetadata:
 
         transform_lightbox_images(app, doc, "index")
 
-        first_overlay = next(child for child in doc[0] if isinstance(child, LightboxOverlay))
-        second_overlay = next(child for child in doc[1] if isinstance(child, LightboxOverlay))
+        first_overlay = child_of_type(doc[0], LightboxOverlay)
+        second_overlay = child_of_type(doc[1], LightboxOverlay)
         assert first_overlay["gallery_next_target"] == "lightbox-index-2"
         assert second_overlay["gallery_prev_target"] == "lightbox-index-1"
 
@@ -741,38 +805,32 @@ class TestGalleryMetadata:
 class TestSizeStyleFormula:
     """Test build-time CSS sizing logic."""
 
-    def _get_overlay_style(self, sphinx_env, options):
-        state = Mock()
-        state.document.settings.env = sphinx_env
-        state_machine = Mock()
-        state_machine.get_source_and_line.return_value = ("test.rst", 1)
+    pytestmark = pytest.mark.unit
+
+    def _get_overlay_style(self, directive_state, options):
+        state, state_machine = directive_state
         directive = LightboxDirective(
             "lightbox", ["/i.png"], options, [], 1, 0, "", state, state_machine
         )
-        with patch("lightbox.lightbox.os.path.isfile", return_value=True):
-            res = directive.run()
-        overlay = next(n for n in res[0].children if isinstance(n, LightboxOverlay))
+        res = directive.run()
+        overlay = child_of_type(res[0], LightboxOverlay)
         return overlay["size_style"]
 
-    @pytest.mark.unit
-    def test_size_style_contains_numeric_ratio(self, sphinx_env):
-        style = self._get_overlay_style(sphinx_env, {})
+    def test_size_style_contains_numeric_ratio(self, directive_state, isfile_true):
+        style = self._get_overlay_style(directive_state, _NO_OPTIONS)
         assert "1.0000" in style
         assert "var(--aspect-ratio)" not in style
 
-    @pytest.mark.unit
-    def test_default_size_style_uses_95(self, sphinx_env):
-        style = self._get_overlay_style(sphinx_env, {})
+    def test_default_size_style_uses_95(self, directive_state, isfile_true):
+        style = self._get_overlay_style(directive_state, _NO_OPTIONS)
         assert "min(95vw," in style
 
-    @pytest.mark.unit
-    def test_custom_percentage_used_in_size_style(self, sphinx_env):
-        style = self._get_overlay_style(sphinx_env, {"percentage": [50, 80]})
+    def test_custom_percentage_used_in_size_style(self, directive_state, isfile_true):
+        style = self._get_overlay_style(directive_state, {"percentage": [50, 80]})
         assert "min(80vw," in style
 
-    @pytest.mark.unit
-    def test_first_percentage_does_not_affect_size_style(self, sphinx_env):
-        style = self._get_overlay_style(sphinx_env, {"percentage": [30, 70]})
+    def test_first_percentage_does_not_affect_size_style(self, directive_state, isfile_true):
+        style = self._get_overlay_style(directive_state, {"percentage": [30, 70]})
         assert "min(70vw," in style
         assert "30vw" not in style
 
@@ -785,68 +843,57 @@ class TestSizeStyleFormula:
 class TestMissingImage:
     """Test behaviour for invalid image paths."""
 
-    @pytest.mark.unit
-    def test_missing_image_returns_empty_list(self, sphinx_env):
-        state = Mock()
-        state.document.settings.env = sphinx_env
-        directive = LightboxDirective("lightbox", ["/no.png"], {}, [], 1, 0, "", state, Mock())
-        with (
-            patch("lightbox.lightbox.os.path.isfile", return_value=False),
-            patch("lightbox.lightbox.logger"),
-        ):
+    pytestmark = pytest.mark.unit
+
+    def test_missing_image_returns_empty_list(self, directive_state, isfile_false):
+        state, state_machine = directive_state
+        directive = LightboxDirective(
+            "lightbox", ["/no.png"], {}, [], 1, 0, "", state, state_machine
+        )
+        with patch("lightbox.lightbox.logger"):
             assert directive.run() == []
 
-    @pytest.mark.unit
-    def test_missing_image_emits_warning(self, sphinx_env):
-        state = Mock()
-        state.document.settings.env = sphinx_env
-        directive = LightboxDirective("lightbox", ["/no.png"], {}, [], 1, 0, "", state, Mock())
-        with (
-            patch("lightbox.lightbox.os.path.isfile", return_value=False),
-            patch("lightbox.lightbox.logger") as mock_logger,
-        ):
+    def test_missing_image_emits_warning(self, directive_state, isfile_false):
+        state, state_machine = directive_state
+        directive = LightboxDirective(
+            "lightbox", ["/no.png"], {}, [], 1, 0, "", state, state_machine
+        )
+        with patch("lightbox.lightbox.logger") as mock_logger:
             directive.run()
         assert mock_logger.warning.call_args.kwargs.get("subtype") == "image_not_found"
 
-    @pytest.mark.unit
-    def test_path_traversal_emits_security_warning(self, sphinx_env):
-        state = Mock()
-        state.document.settings.env = sphinx_env
+    def test_path_traversal_emits_security_warning(self, directive_state, isfile_true):
+        state, state_machine = directive_state
         directive = LightboxDirective(
-            "lightbox", ["../../etc/passwd"], {}, [], 1, 0, "", state, Mock()
+            "lightbox", ["../../etc/passwd"], {}, [], 1, 0, "", state, state_machine
         )
-        with (
-            patch("lightbox.lightbox.os.path.isfile", return_value=True),
-            patch("lightbox.lightbox.logger") as mock_logger,
-        ):
+        with patch("lightbox.lightbox.logger") as mock_logger:
             directive.run()
         assert mock_logger.warning.call_args.kwargs.get("subtype") == "path_traversal"
 
-    @pytest.mark.unit
-    def test_path_traversal_sibling_directory_bypass(self, sphinx_env):
+    def test_path_traversal_sibling_directory_bypass(
+        self, sphinx_env, directive_state, isfile_true
+    ):
         """Ensure sibling directories sharing the srcdir prefix are blocked."""
-        state = Mock()
+        state, state_machine = directive_state
         # Set a specific srcdir prefix to test against
         sphinx_env.srcdir = "/var/www/docs"
-        state.document.settings.env = sphinx_env
 
         # Attempt to access a sibling directory that starts with "/var/www/docs"
         directive = LightboxDirective(
-            "lightbox", ["../docs-secret/image.png"], {}, [], 1, 0, "", state, Mock()
+            "lightbox", ["../docs-secret/image.png"], {}, [], 1, 0, "", state, state_machine
         )
 
-        with (
-            patch("lightbox.lightbox.os.path.isfile", return_value=True),
-            patch("lightbox.lightbox.logger") as mock_logger,
-        ):
+        with patch("lightbox.lightbox.logger") as mock_logger:
             directive.run()
 
         # If the bypass works, this assert will fail because the logger was never called
         assert mock_logger.warning.called, "Path traversal bypass succeeded!"
         assert mock_logger.warning.call_args.kwargs.get("subtype") == "path_traversal"
 
-    @pytest.mark.unit
-    def test_symlink_outside_source_directory_is_rejected(self, sphinx_env, tmp_path):
+    def test_symlink_outside_source_directory_is_rejected(
+        self, sphinx_env, tmp_path, directive_state
+    ):
         srcdir = tmp_path / "src"
         srcdir.mkdir()
         outside = tmp_path / "outside.png"
@@ -857,15 +904,63 @@ class TestMissingImage:
             pytest.skip(f"symlinks unavailable: {exc}")
 
         sphinx_env.srcdir = str(srcdir)
-        state = Mock()
-        state.document.settings.env = sphinx_env
-        directive = LightboxDirective("lightbox", ["/linked.png"], {}, [], 1, 0, "", state, Mock())
+        state, state_machine = directive_state
+        directive = LightboxDirective(
+            "lightbox", ["/linked.png"], {}, [], 1, 0, "", state, state_machine
+        )
 
         with patch("lightbox.lightbox.logger") as mock_logger:
             assert directive.run() == []
 
         assert mock_logger.warning.call_args.kwargs.get("subtype") == "path_traversal"
 
+    def test_repeated_image_path_resolution_is_cached_per_build(self, directive_state):
+        state, state_machine = directive_state
+        app = Mock()
+        app.config.html_static_path = []
+
+        def run():
+            LightboxDirective("lightbox", ["/i.png"], {}, [], 1, 0, "", state, state_machine).run()
+
+        with patch("lightbox.lightbox.os.path.isfile", return_value=True) as isfile:
+            run()
+            run()
+            assert _resolve_cached.cache_info().misses == 1
+            # Existence is not cached: files generated mid-build must be found.
+            assert isfile.call_count == 2
+
+            _builder_inited(app)
+            run()
+            assert _resolve_cached.cache_info().misses == 1
+
+    def test_root_relative_image_is_resolved_once_across_directories(
+        self, sphinx_env, directive_state, isfile_true
+    ):
+        state, state_machine = directive_state
+
+        for docname in ("index", "guide/intro", "api/ref/module"):
+            sphinx_env.docname = docname
+            directive = LightboxDirective(
+                "lightbox", ["/i.png"], {}, [], 1, 0, "", state, state_machine
+            )
+            directive.run()
+
+        assert _resolve_cached.cache_info().misses == 1
+
+    def test_image_created_during_build_is_found(self, directive_state):
+        state, state_machine = directive_state
+
+        def run():
+            return LightboxDirective(
+                "lightbox", ["/i.png"], {}, [], 1, 0, "", state, state_machine
+            ).run()
+
+        with patch("lightbox.lightbox.logger"):
+            with patch("lightbox.lightbox.os.path.isfile", return_value=False):
+                assert run() == []
+            with patch("lightbox.lightbox.os.path.isfile", return_value=True):
+                assert run() != []
+
 
 # ---------------------------------------------------------------------------
 # TestHtmlOutput
@@ -875,98 +970,57 @@ class TestMissingImage:
 class TestHtmlOutput:
     """Test HTML visitor functions directly."""
 
+    pytestmark = pytest.mark.unit
+
     @staticmethod
     def _make_translator():
-        t = Mock()
-        t.body = []
-        t.builder = Mock(images={})
-        return t
+        return StubBuilder().translator
 
     # --- Container ---
 
-    @pytest.mark.unit
     def test_container_opens_and_closes_div(self):
-        from lightbox.lightbox import (
-            depart_lightbox_container_html,
-            visit_lightbox_container_html,
-        )
-
         t = self._make_translator()
         visit_lightbox_container_html(t, LightboxContainer())
         depart_lightbox_container_html(t, LightboxContainer())
-        output = "".join(t.body)
+        output = t.rendered()
         assert '<div class="lightbox-container">' in output
         assert "</div>" in output
 
     # --- Trigger ---
 
-    @pytest.mark.unit
     def test_trigger_renders_label_and_img(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
-
         t = self._make_translator()
-        node = LightboxTrigger()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {"alt": "A", "thumbnail_width": "1%", "custom_class": ""}.get(k, d)
+        node = trigger_node(alt="A", thumbnail_width="1%")
         visit_lightbox_trigger_html(t, node)
-        output = "".join(t.body)
+        assert len(t.body) == 1
+        output = t.body[0]
         assert "lightbox-trigger-label" in output
         assert "<img" in output
 
-    @pytest.mark.unit
     def test_trigger_thumbnail_width_applied(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
-
         t = self._make_translator()
-        node = LightboxTrigger()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {"alt": "A", "thumbnail_width": "60%", "custom_class": ""}.get(k, d)
+        node = trigger_node(alt="A", thumbnail_width="60%")
         visit_lightbox_trigger_html(t, node)
-        assert "width: 60%;" in "".join(t.body)
+        assert "width: 60%;" in t.rendered()
 
-    @pytest.mark.unit
     def test_trigger_rejects_unsafe_thumbnail_width(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
-
         t = self._make_translator()
-        node = LightboxTrigger()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "thumbnail_width": "1%; background: url(javascript:alert(1))",
-            "custom_class": "",
-        }.get(k, d)
+        node = trigger_node(alt="A", thumbnail_width="1%; background: url(javascript:alert(1))")
         visit_lightbox_trigger_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert "javascript:" not in output
         assert "width: 100%;" in output
 
-    @pytest.mark.unit
     def test_trigger_aria_label_contains_alt_text(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
-
         t = self._make_translator()
-        node = LightboxTrigger()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "Server diagram",
-            "thumbnail_width": "100%",
-            "custom_class": "",
-        }.get(k, d)
+        node = trigger_node(alt="Server diagram")
         visit_lightbox_trigger_html(t, node)
         assert (
             '<span class="lightbox-visually-hidden">Enlarge image: Server diagram</span>'
-            in "".join(t.body)
+            in t.rendered()
         )
 
-    @pytest.mark.unit
     def test_trigger_uses_filename_when_alt_text_is_empty(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
-
         t = self._make_translator()
         node = LightboxTrigger(
             uri="images/server_diagram-final.png",
@@ -978,70 +1032,35 @@ class TestHtmlOutput:
 
         visit_lightbox_trigger_html(t, node)
 
-        output = "".join(t.body)
+        output = t.rendered()
         assert "Enlarge image: server diagram final" in output
         assert 'alt=""' in output
 
-    @pytest.mark.unit
     def test_trigger_custom_class_applied(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
-
         t = self._make_translator()
-        node = LightboxTrigger()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "thumbnail_width": "100%",
-            "custom_class": "with-border",
-        }.get(k, d)
+        node = trigger_node(alt="A", custom_class="with-border")
         visit_lightbox_trigger_html(t, node)
-        assert "lightbox-trigger with-border" in "".join(t.body)
+        assert "lightbox-trigger with-border" in t.rendered()
 
     # --- Overlay ---
 
-    @pytest.mark.unit
     def test_overlay_checkbox_input_rendered(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "lb-7"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(uri="t.png", checkbox_id="lb-7", alt="A")
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert '<input type="checkbox" id="lb-7"' in output
         assert 'class="lightbox-toggle"' in output
 
-    @pytest.mark.unit
     def test_overlay_role_dialog_present(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(uri="t.png", alt="A")
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert 'role="dialog"' in output
         assert 'aria-modal="true"' in output
 
-    @pytest.mark.unit
     def test_overlay_uses_filename_for_dialog_name_when_alt_text_is_empty(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
         node = LightboxOverlay(
             uri="images/server_diagram-final.png",
@@ -1055,205 +1074,111 @@ class TestHtmlOutput:
 
         visit_lightbox_overlay_html(t, node)
 
-        output = "".join(t.body)
+        output = t.rendered()
         assert 'aria-label="server diagram final"' in output
         assert 'alt="server diagram final"' in output
 
-    @pytest.mark.unit
     def test_overlay_close_button_rendered(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(uri="t.png", alt="A")
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert 'class="lightbox-close"' in output
         assert '<span class="lightbox-visually-hidden">Close lightbox</span>' in output
         assert "&times;" in output
 
-    @pytest.mark.unit
     def test_overlay_renders_with_secure_style(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "Cap",
-            "custom_class": "",
-            "size_style": "width: min(95vw, calc(95vh * 1.5));",
-        }.get(k, d)
+        node = overlay_node(
+            uri="t.png", alt="A", caption="Cap", size_style="width: min(95vw, calc(95vh * 1.5));"
+        )
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert 'style="width: min(95vw, calc(95vh * 1.5));"' in output
         assert "onload=" not in output
 
-    @pytest.mark.unit
     def test_overlay_rejects_unsafe_inline_style(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "",
-            "size_style": "width: url(javascript:alert(1));",
-        }.get(k, d)
+        node = overlay_node(uri="t.png", alt="A", size_style="width: url(javascript:alert(1));")
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert "javascript:" not in output
         assert "style=" not in output
 
-    @pytest.mark.unit
     def test_overlay_caption_rendered_when_present(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "Figure 1",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(uri="t.png", alt="A", caption="Figure 1")
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert '<div class="lightbox-text">' in output
         assert '<p class="lightbox-caption">Figure 1</p>' in output
 
-    @pytest.mark.unit
     def test_overlay_legend_rendered_when_present(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "legend": "Longer explanation.",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(uri="t.png", alt="A", legend="Longer explanation.")
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert '<div class="lightbox-text">' in output
         assert '<div class="lightbox-legend">Longer explanation.</div>' in output
 
-    @pytest.mark.unit
     def test_overlay_caption_omitted_when_empty(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(uri="t.png", alt="A")
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert "lightbox-caption" not in output
         assert "lightbox-text" not in output
 
-    @pytest.mark.unit
     def test_overlay_backdrop_close_rendered(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(uri="t.png", alt="A")
         visit_lightbox_overlay_html(t, node)
-        assert 'class="lightbox-backdrop-close"' in "".join(t.body)
+        assert 'class="lightbox-backdrop-close"' in t.rendered()
 
-    @pytest.mark.unit
     def test_overlay_img_custom_class_applied(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "with-border",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(uri="t.png", alt="A", custom_class="with-border")
         visit_lightbox_overlay_html(t, node)
-        assert 'class="with-border"' in "".join(t.body)
+        assert 'class="with-border"' in t.rendered()
 
-    @pytest.mark.unit
     def test_overlay_gallery_controls_render_when_targets_present(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
-
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node["gallery_index"] = 2
-        node["gallery_count"] = 3
-        node["gallery_prev_target"] = "l0"
-        node["gallery_next_target"] = "l2"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "",
-            "size_style": "",
-            "gallery_index": 2,
-            "gallery_count": 3,
-            "gallery_prev_target": "l0",
-            "gallery_next_target": "l2",
-        }.get(k, d)
+        node = overlay_node(
+            uri="t.png",
+            gallery_index=2,
+            gallery_count=3,
+            gallery_prev_target="l0",
+            gallery_next_target="l2",
+            alt="A",
+        )
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
+        output = t.rendered()
         assert 'class="lightbox-gallery-control lightbox-gallery-prev"' in output
         assert 'data-lightbox-target="l0"' in output
         assert 'class="lightbox-gallery-control lightbox-gallery-next"' in output
         assert 'data-lightbox-target="l2"' in output
 
-    @pytest.mark.unit
     def test_overlay_gallery_controls_omitted_without_targets(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
+        t = self._make_translator()
+        node = overlay_node(uri="t.png", alt="A")
+        visit_lightbox_overlay_html(t, node)
+        assert "lightbox-gallery-control" not in t.rendered()
 
+    def test_overlay_is_appended_to_body_once(self):
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "t.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(
+            uri="t.png",
+            alt="A",
+            caption="Cap",
+            legend="Leg",
+            gallery_prev_target="l0",
+            gallery_next_target="l2",
+        )
         visit_lightbox_overlay_html(t, node)
-        assert "lightbox-gallery-control" not in "".join(t.body)
+        assert len(t.body) == 1
+        output = t.body[0]
+        assert output.index("lightbox-gallery-next") < output.index('class="lightbox-content"')
+        assert output.index("lightbox-caption") < output.index("lightbox-legend")
 
 
 # ---------------------------------------------------------------------------
@@ -1264,179 +1189,206 @@ class TestHtmlOutput:
 class TestHtmlEscaping:
     """Test that all user-supplied fields are properly HTML escaped."""
 
+    pytestmark = pytest.mark.unit
+
     @staticmethod
     def _make_translator():
-        t = Mock()
-        t.body = []
-        t.builder = Mock(images={})
-        return t
+        return StubBuilder().translator
 
-    @pytest.mark.unit
-    def test_trigger_alt_script_injection_escaped(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
-
-        t = self._make_translator()
-        node = LightboxTrigger()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "<script>alert(1)</script>",
-            "thumbnail_width": "1%",
-            "custom_class": "",
-        }.get(k, d)
-        visit_lightbox_trigger_html(t, node)
-        output = "".join(t.body)
-        assert "<script>" not in output
-        assert "&lt;script&gt;" in output
+    def test_attribute_escaping_matches_html_escape(self):
+        value = """&amp; <b class="x">it's</b> &"""
+        assert _esc_attr(value) == html_escape(value, quote=True)
 
-    @pytest.mark.unit
-    def test_trigger_alt_double_quote_escaped(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
+    def test_attribute_without_specials_returned_unchanged(self):
+        value = "Plain caption text"
+        assert _esc_attr(value) is value
 
+    def test_overlay_escapes_every_html_special(self):
         t = self._make_translator()
-        node = LightboxTrigger()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": 'Say "hello"',
-            "thumbnail_width": "1%",
-            "custom_class": "",
-        }.get(k, d)
-        visit_lightbox_trigger_html(t, node)
-        assert "&quot;hello&quot;" in "".join(t.body)
+        node = overlay_node(alt="<a href='x'>", caption='Tom & "Jerry"')
+        visit_lightbox_overlay_html(t, node)
+        output = t.rendered()
+        # One scan collects every entity instead of a substring search per entity.
+        assert set(_HTML_ENTITY_RE.findall(output)) == {"&lt;", "&gt;", "&amp;", "&quot;", "&#x27;"}
 
-    @pytest.mark.unit
-    def test_caption_escaping(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
+    def test_overlay_without_alt_or_filename_stem_uses_generic_label(self):
+        t = self._make_translator()
+        visit_lightbox_overlay_html(t, LightboxOverlay(uri="images/__.png", checkbox_id="x"))
+        assert 'aria-label="Image"' in t.rendered()
 
+    def test_overlay_values_with_percent_signs_are_not_reformatted(self):
         t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "<b>Bold</b>",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
+        node = overlay_node(alt="100%(alt)s", caption="50% %s %(cid)s")
         visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
-        assert "<b>" not in output
-        assert "&lt;b&gt;Bold&lt;/b&gt;" in output
+        output = t.rendered()
+        assert 'aria-label="100%(alt)s"' in output
+        assert '<p class="lightbox-caption">50% %s %(cid)s</p>' in output
+
+    @pytest.mark.parametrize(
+        ("attributes", "must_contain", "must_not_contain"),
+        [
+            ({"alt": "<script>alert(1)</script>"}, "&lt;script&gt;", "<script>"),
+            ({"alt": 'Say "hello"'}, "&quot;hello&quot;", None),
+            # Double quotes inside the src attribute must be escaped
+            ({"uri": 'img "name".png', "alt": "A"}, "&quot;name&quot;", None),
+            ({"alt": "A", "custom_class": '"><script>'}, "&lt;script&gt;", "<script>"),
+        ],
+        ids=["alt-script", "alt-quotes", "uri", "custom-class"],
+    )
+    def test_trigger_values_escaped(self, attributes, must_contain, must_not_contain):
+        t = self._make_translator()
+        visit_lightbox_trigger_html(t, trigger_node(**attributes))
+        output = t.rendered()
+        assert must_contain in output
+        if must_not_contain is not None:
+            assert must_not_contain not in output
+
+    @pytest.mark.parametrize(
+        ("attributes", "must_contain", "must_not_contain"),
+        [
+            ({"alt": "A", "caption": "<b>Bold</b>"}, "&lt;b&gt;Bold&lt;/b&gt;", "<b>"),
+            (
+                {"alt": '"onmouseover="alert(1)'},
+                'alt="&quot;onmouseover=&quot;alert(1)"',
+                'onmouseover="',
+            ),
+            ({"alt": "A", "caption": "Tom & Jerry"}, "Tom &amp; Jerry", None),
+            # Caption uses quote=True for defence-in-depth
+            ({"alt": "A", "caption": 'She said "hi"'}, "&quot;hi&quot;", None),
+            (
+                {
+                    "alt": "A",
+                    "gallery_index": 1,
+                    "gallery_count": 2,
+                    "gallery_next_target": 'bad" onclick="alert(1)',
+                },
+                "bad&quot; onclick=&quot;alert(1)",
+                'onclick="alert(1)',
+            ),
+        ],
+        ids=["caption-markup", "alt-attribute", "caption-ampersand", "caption-quotes", "gallery"],
+    )
+    def test_overlay_values_escaped(self, attributes, must_contain, must_not_contain):
+        t = self._make_translator()
+        visit_lightbox_overlay_html(t, overlay_node(**attributes))
+        output = t.rendered()
+        assert must_contain in output
+        if must_not_contain is not None:
+            assert must_not_contain not in output
 
-    @pytest.mark.unit
-    def test_overlay_alt_text_escaped(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
 
-        t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": '"onmouseover="alert(1)',
-            "caption": "",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
-        visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
-        assert (
-            "onmouseover" not in output.split("&quot;onmouseover")[0]
-            if "&quot;onmouseover" in output
-            else True
-        )
-        assert "&quot;" in output
+# ---------------------------------------------------------------------------
+# TestHtmlStructure
+# ---------------------------------------------------------------------------
 
-    @pytest.mark.unit
-    def test_uri_special_chars_escaped(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
+_VOID_ELEMENTS = frozenset({"img", "input"})
 
-        t = self._make_translator()
-        node = LightboxTrigger()
-        node["uri"] = 'img "name".png'
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {"alt": "A", "thumbnail_width": "1%", "custom_class": ""}.get(k, d)
-        visit_lightbox_trigger_html(t, node)
-        output = "".join(t.body)
-        # Double quotes inside the src attribute must be escaped
-        assert "&quot;name&quot;" in output
 
-    @pytest.mark.unit
-    def test_custom_class_escaped(self):
-        from lightbox.lightbox import visit_lightbox_trigger_html
+class _TagTracker(HTMLParser):
+    """Record mismatched and unclosed tags in an HTML fragment."""
 
-        t = self._make_translator()
-        node = LightboxTrigger()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "thumbnail_width": "1%",
-            "custom_class": '"><script>',
-        }.get(k, d)
-        visit_lightbox_trigger_html(t, node)
-        output = "".join(t.body)
-        assert "<script>" not in output
-        assert "&lt;script&gt;" in output
+    def __init__(self):
+        super().__init__()
+        self.errors = []
+        self._stack = []
 
-    @pytest.mark.unit
-    def test_caption_with_ampersand_escaped(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
+    def handle_starttag(self, tag, attrs):
+        if tag not in _VOID_ELEMENTS:
+            self._stack.append(tag)
 
-        t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "Tom & Jerry",
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
-        visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
-        assert "Tom &amp; Jerry" in output
+    def handle_endtag(self, tag):
+        if not self._stack or self._stack[-1] != tag:
+            self.errors.append(f"unexpected </{tag}> (open: {self._stack})")
+        else:
+            self._stack.pop()
 
-    @pytest.mark.unit
-    def test_overlay_caption_with_quotes_escaped(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
+    @property
+    def unclosed_tags(self):
+        return list(self._stack)
 
-        t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": 'She said "hi"',
-            "custom_class": "",
-            "size_style": "",
-        }.get(k, d)
-        visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
-        # Caption uses quote=True for defence-in-depth
-        assert "&quot;hi&quot;" in output
 
-    @pytest.mark.unit
-    def test_gallery_targets_are_escaped(self):
-        from lightbox.lightbox import visit_lightbox_overlay_html
+def _render_full_lightbox(
+    caption="", custom_class="", prev_target="", next_target="", alt="Alt text"
+):
+    """Render a container, trigger and overlay through the real HTML visitors."""
+    t = StubBuilder().translator
+    container = LightboxContainer()
+    trigger = LightboxTrigger(uri="i.png", alt=alt, checkbox_id="l1", custom_class=custom_class)
+    gallery = {}
+    if prev_target or next_target:
+        gallery = {
+            "gallery_index": 2,
+            "gallery_count": 3,
+            "gallery_prev_target": prev_target,
+            "gallery_next_target": next_target,
+        }
+    overlay = LightboxOverlay(
+        uri="i.png",
+        alt=alt,
+        caption=caption,
+        checkbox_id="l1",
+        custom_class=custom_class,
+        **gallery,
+    )
+    visit_lightbox_container_html(t, container)
+    visit_lightbox_trigger_html(t, trigger)
+    depart_lightbox_trigger_html(t, trigger)
+    visit_lightbox_overlay_html(t, overlay)
+    depart_lightbox_overlay_html(t, overlay)
+    depart_lightbox_container_html(t, container)
+    return t.rendered()
+
+
+# Golden output of _render_full_lightbox() with default arguments; the basic
+# case is compared exactly, so it also catches changes that stay well formed.
+_BASIC_EXPECTED = (
+    '<div class="lightbox-container">\n'
+    '<label for="l1" class="lightbox-trigger-label">\n'
+    '  <span class="lightbox-trigger-control" role="button" tabindex="0" '
+    'data-lightbox-target="l1">\n'
+    '    <span class="lightbox-visually-hidden">Enlarge image: Alt text</span>\n'
+    '    <img src="i.png" alt="" class="lightbox-trigger" style="width: 100%;">\n'
+    "  </span>\n"
+    "</label>\n"
+    '<input type="checkbox" id="l1" class="lightbox-toggle" aria-hidden="true" tabindex="-1">\n'
+    '<div class="lightbox-overlay" role="dialog" aria-modal="true" aria-label="Alt text">\n'
+    '  <label for="l1" class="lightbox-close-label">'
+    '<span class="lightbox-close" role="button" tabindex="0" data-lightbox-target="l1">'
+    '<span aria-hidden="true">&times;</span>'
+    '<span class="lightbox-visually-hidden">Close lightbox</span></span></label>\n'
+    '  <div class="lightbox-content">\n'
+    '    <img src="i.png" alt="Alt text">\n'
+    "  </div>\n"
+    '  <label for="l1" class="lightbox-backdrop-close"></label>\n'
+    "</div>\n"
+    "</div>\n"
+)
 
-        t = self._make_translator()
-        node = LightboxOverlay()
-        node["uri"] = "i.png"
-        node["checkbox_id"] = "l1"
-        node.get = lambda k, d: {
-            "alt": "A",
-            "caption": "",
-            "custom_class": "",
-            "size_style": "",
-            "gallery_index": 1,
-            "gallery_count": 2,
-            "gallery_next_target": 'bad" onclick="alert(1)',
-        }.get(k, d)
-        visit_lightbox_overlay_html(t, node)
-        output = "".join(t.body)
-        assert 'onclick="alert(1)' not in output
-        assert "bad&quot; onclick=&quot;alert(1)" in output
+
+class TestHtmlStructure:
+    """Test that the combined visitor output is balanced HTML."""
+
+    pytestmark = pytest.mark.unit
+
+    def test_basic_output_matches_snapshot(self):
+        assert _render_full_lightbox() == _BASIC_EXPECTED
+
+    @pytest.mark.parametrize(
+        "kwargs",
+        [
+            {"caption": "This is a caption"},
+            {"caption": '<em>italic</em> & "quoted"'},
+            {"custom_class": "with-border"},
+            {"prev_target": "l0", "next_target": "l2"},
+        ],
+        ids=["caption", "special", "custom_class", "gallery"],
+    )
+    def test_well_formed(self, kwargs):
+        tracker = _TagTracker()
+        tracker.feed(_render_full_lightbox(**kwargs))
+        tracker.close()
+        assert tracker.errors == []
+        assert tracker.unclosed_tags == []
 
 
 # ---------------------------------------------------------------------------
@@ -1447,56 +1399,46 @@ class TestHtmlEscaping:
 class TestUriResolution:
     """Test _resolve_output_uri helper."""
 
-    @pytest.mark.unit
-    def test_resolve_output_uri_uses_imgpath(self):
-        from lightbox.lightbox import _resolve_output_uri
+    pytestmark = pytest.mark.unit
 
-        builder = Mock(images={"test.png": "t1.png"}, imgpath="../../_images")
+    def test_resolve_output_uri_uses_imgpath(self):
+        builder = SimpleNamespace(images={"test.png": "t1.png"}, imgpath="../../_images")
         assert _resolve_output_uri(builder, "test.png") == "../../_images/t1.png"
 
-    @pytest.mark.unit
     def test_resolve_output_uri_unregistered_fallback(self):
-        from lightbox.lightbox import _resolve_output_uri
-
-        builder = Mock(images={})
+        builder = SimpleNamespace(images={})
         assert _resolve_output_uri(builder, "test.png") == "test.png"
 
-    @pytest.mark.unit
     def test_resolve_output_uri_no_imgpath_defaults(self):
-        from lightbox.lightbox import _resolve_output_uri
-
         # Builder with images but no imgpath attribute → defaults to "_images"
-        builder = Mock(spec=["images"])
-        builder.images = {"test.png": "t1.png"}
+        builder = SimpleNamespace(images={"test.png": "t1.png"})
         assert _resolve_output_uri(builder, "test.png") == "_images/t1.png"
 
-    @pytest.mark.unit
     def test_resolve_output_uri_uses_environment_images(self):
-        from lightbox.lightbox import _resolve_output_uri
-
-        builder = Mock()
-        builder.images = {}
-        builder.imgpath = "_images"
-        builder.env.images = {"images/test.png": ({"index"}, "test-hash.png")}
+        builder = SimpleNamespace(
+            images={},
+            imgpath="_images",
+            env=SimpleNamespace(images={"images/test.png": ({"index"}, "test-hash.png")}),
+        )
         assert _resolve_output_uri(builder, "images/test.png") == "_images/test-hash.png"
 
-    @pytest.mark.unit
     def test_resolve_output_uri_uses_deduplicated_builder_image(self, tmp_path):
-        from lightbox.lightbox import _resolve_output_uri
-
         image_dir = tmp_path / "images"
         image_dir.mkdir()
         (image_dir / "first.png").write_bytes(b"same image content")
         (image_dir / "second.png").write_bytes(b"same image content")
 
-        builder = Mock()
-        builder.images = {"images/second.png": "second.png"}
-        builder.imgpath = "_images"
-        builder.env.srcdir = str(tmp_path)
-        builder.env.images = {
-            "images/first.png": ({"index"}, "first.png"),
-            "images/second.png": ({"index"}, "second.png"),
-        }
+        builder = SimpleNamespace(
+            images={"images/second.png": "second.png"},
+            imgpath="_images",
+            env=SimpleNamespace(
+                srcdir=str(tmp_path),
+                images={
+                    "images/first.png": ({"index"}, "first.png"),
+                    "images/second.png": ({"index"}, "second.png"),
+                },
+            ),
+        )
 
         assert _resolve_output_uri(builder, "images/first.png") == "_images/second.png"
 
@@ -1509,10 +1451,9 @@ class TestUriResolution:
 class TestMissingImageCopy:
     """Test build-finished copying for transformed lightbox image assets."""
 
-    @pytest.mark.unit
-    def test_missing_html_image_targets_finds_only_missing_local_images(self, tmp_path):
-        from lightbox.lightbox import _missing_html_image_targets
+    pytestmark = pytest.mark.unit
 
+    def test_missing_html_image_targets_finds_only_missing_local_images(self, tmp_path):
         outdir = tmp_path / "html"
         image_dir = outdir / "_images"
         image_dir.mkdir(parents=True)
@@ -1527,10 +1468,7 @@ class TestMissingImageCopy:
 
         assert _missing_html_image_targets(str(outdir)) == {"missing.png"}
 
-    @pytest.mark.unit
     def test_copy_missing_lightbox_images_copies_referenced_env_image(self, tmp_path):
-        from lightbox.lightbox import _copy_missing_lightbox_images
-
         srcdir = tmp_path / "src"
         outdir = tmp_path / "html"
         source_image = srcdir / "images" / "missing.png"
@@ -1556,10 +1494,7 @@ class TestMissingImageCopy:
 
         assert (outdir / "_images" / "missing.png").read_bytes() == b"image"
 
-    @pytest.mark.unit
     def test_copy_missing_lightbox_images_blocks_source_traversal(self, tmp_path):
-        from lightbox.lightbox import _copy_missing_lightbox_images
-
         srcdir = tmp_path / "src"
         outside = tmp_path / "outside.png"
         outdir = tmp_path / "html"
@@ -1594,20 +1529,16 @@ class TestMissingImageCopy:
 class TestSphinxEnvironmentMetadata:
     """Test Sphinx environment metadata used for parallel-safe reads."""
 
-    @pytest.mark.unit
-    def test_register_lightbox_image_tracks_uris_by_doc(self):
-        from lightbox.lightbox import _register_lightbox_image
+    pytestmark = pytest.mark.unit
 
+    def test_register_lightbox_image_tracks_uris_by_doc(self):
         env = Mock()
 
         _register_lightbox_image(env, "index", "/images/example.png")
 
         assert env.lightbox_image_uris_by_doc == {"index": {"images/example.png"}}
 
-    @pytest.mark.unit
     def test_purge_lightbox_images_removes_only_target_doc(self):
-        from lightbox.lightbox import _purge_lightbox_images
-
         env = Mock()
         env.lightbox_image_uris_by_doc = {
             "index": {"images/index.png"},
@@ -1618,10 +1549,7 @@ class TestSphinxEnvironmentMetadata:
 
         assert env.lightbox_image_uris_by_doc == {"usage": {"images/usage.png"}}
 
-    @pytest.mark.unit
     def test_merge_lightbox_images_merges_requested_parallel_docs(self):
-        from lightbox.lightbox import _merge_lightbox_images
-
         env = Mock()
         env.lightbox_image_uris_by_doc = {"index": {"images/index.png"}}
         other = Mock()
@@ -1637,12 +1565,8 @@ class TestSphinxEnvironmentMetadata:
             "usage": {"images/usage.png"},
         }
 
-    @pytest.mark.unit
     def test_setup_declares_sphinx_metadata_and_parallel_events(self):
-        from lightbox.lightbox import __version__, setup
-
-        app = Mock()
-        app.config.html_static_path = []
+        app = Mock(spec=Sphinx)
 
         metadata = setup(app)
 
@@ -1654,15 +1578,10 @@ class TestSphinxEnvironmentMetadata:
         connected_events = [call.args[0] for call in app.connect.call_args_list]
         assert "env-purge-doc" in connected_events
         assert "env-merge-info" in connected_events
-        app.add_post_transform.assert_called_once()
-        assert app.add_post_transform.call_args.args[0].__name__ == "LightboxImageTransform"
+        post_transforms = [call.args[0].__name__ for call in app.add_post_transform.call_args_list]
+        assert post_transforms == ["LightboxImageTransform", "LightboxFallbackTransform"]
 
-    @pytest.mark.unit
     def test_runtime_version_matches_distribution_metadata(self):
-        from importlib.metadata import version
-
-        from lightbox.lightbox import __version__
-
         assert __version__ == version("sphinx-lightbox")
 
 
@@ -1674,10 +1593,9 @@ class TestSphinxEnvironmentMetadata:
 class TestStaticPathRegistration:
     """Test that the extension registers its static directory with Sphinx."""
 
-    @pytest.mark.unit
-    def test_builder_inited_appends_static_path(self):
-        from lightbox.lightbox import _builder_inited
+    pytestmark = pytest.mark.unit
 
+    def test_builder_inited_appends_static_path(self):
         app = Mock()
         app.config.html_static_path = []
 
@@ -1687,11 +1605,8 @@ class TestStaticPathRegistration:
         assert len(app.config.html_static_path) == 1
         assert app.config.html_static_path[0] == "/tmp/src/static"
 
-    @pytest.mark.unit
     def test_builder_inited_is_idempotent(self):
         """Calling _builder_inited twice should not duplicate the static path."""
-        from lightbox.lightbox import _builder_inited
-
         app = Mock()
         app.config.html_static_path = []
 
@@ -1710,45 +1625,63 @@ class TestStaticPathRegistration:
 class TestImageDimensionCalculation:
     """Test build-time aspect ratio calculation."""
 
-    @pytest.mark.unit
-    def test_run_calculates_correct_aspect_ratio(self, sphinx_env):
-        state = Mock()
-        state.document.settings.env = sphinx_env
-        state_machine = Mock()
-        state_machine.get_source_and_line.return_value = ("test.rst", 10)
+    pytestmark = pytest.mark.unit
+
+    def test_run_calculates_correct_aspect_ratio(self, directive_state, isfile_true):
+        state, state_machine = directive_state
         directive = LightboxDirective(
             "lightbox", ["/land.png"], {}, [], 1, 0, "", state, state_machine
         )
-        with (
-            patch("lightbox.lightbox.os.path.isfile", return_value=True),
-            patch("sphinx.util.images.get_image_size", return_value=(800, 400)),
-        ):
+        with patch("lightbox.lightbox.get_image_size", return_value=(800, 400)):
             res = directive.run()
-        overlay = next(n for n in res[0].children if isinstance(n, LightboxOverlay))
+        overlay = child_of_type(res[0], LightboxOverlay)
         assert "2.0000" in overlay["size_style"]
 
-    @pytest.mark.unit
-    def test_run_handles_dimensions_error_gracefully(self, sphinx_env):
-        state = Mock()
-        state.document.settings.env = sphinx_env
-        state_machine = Mock()
-        state_machine.get_source_and_line.return_value = ("test.rst", 10)
+    def test_run_handles_dimensions_error_gracefully(self, directive_state, isfile_true):
+        state, state_machine = directive_state
         directive = LightboxDirective(
             "lightbox", ["/bad.png"], {}, [], 1, 0, "", state, state_machine
         )
         with (
-            patch("lightbox.lightbox.os.path.isfile", return_value=True),
-            patch("sphinx.util.images.get_image_size", side_effect=Exception("Read error")),
+            patch("lightbox.lightbox.get_image_size", side_effect=Exception("Read error")),
             patch("lightbox.lightbox.logger") as mock_logger,
         ):
             res = directive.run()
 
-        overlay = next(n for n in res[0].children if isinstance(n, LightboxOverlay))
+        overlay = child_of_type(res[0], LightboxOverlay)
         # Falls back to 1:1 aspect ratio when image reading fails
         assert "1.0000" in overlay["size_style"]
         assert mock_logger.warning.called
         assert mock_logger.warning.call_args.kwargs.get("subtype") == "image_dimensions"
 
+    def test_run_warns_when_image_format_is_unsupported(self, directive_state, isfile_true):
+        state, state_machine = directive_state
+        directive = LightboxDirective(
+            "lightbox", ["/unknown.bin"], {}, [], 1, 0, "", state, state_machine
+        )
+        with (
+            patch("lightbox.lightbox.get_image_size", return_value=None),
+            patch("lightbox.lightbox.logger") as mock_logger,
+        ):
+            res = directive.run()
+
+        overlay = child_of_type(res[0], LightboxOverlay)
+        assert "1.0000" in overlay["size_style"]
+        assert mock_logger.warning.call_args.kwargs.get("subtype") == "image_dimensions"
+
+    def test_image_size_is_cached_until_file_changes(self, tmp_path):
+        image = tmp_path / "cached.png"
+        image.write_bytes(b"image")
+        with patch("lightbox.lightbox.get_image_size", return_value=(800, 400)) as get_size:
+            assert _image_size(str(image)) == (800, 400)
+            assert _image_size(str(image)) == (800, 400)
+            assert get_size.call_count == 1
+
+            stat = image.stat()
+            os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+            assert _image_size(str(image)) == (800, 400)
+            assert get_size.call_count == 2
+
 
 # ---------------------------------------------------------------------------
 # TestLatexPackageRegistration (1 test)
@@ -1758,16 +1691,8 @@ class TestImageDimensionCalculation:
 class TestLatexPackageRegistration:
     """Test that the extension declares its LaTeX package dependency."""
 
-    @pytest.mark.unit
-    def test_setup_registers_adjustbox_package(self):
-        """setup() should call app.add_latex_package('adjustbox')."""
-        from unittest.mock import Mock
+    pytestmark = pytest.mark.unit
 
-        from lightbox.lightbox import setup
-
-        app = Mock()
-        app.config.html_static_path = []
-
-        setup(app)
-
-        app.add_latex_package.assert_any_call("adjustbox")
+    def test_setup_registers_adjustbox_package(self, configured_app):
+        """setup() should call app.add_latex_package('adjustbox')."""
+        configured_app.add_latex_package.assert_any_call("adjustbox")
@@ -215,6 +215,25 @@ def test_project_version_reads_only_the_project_table(tmp_path: Path) -> None:
     assert _project_version(pyproject) == "1.2.3"
 
 
+@pytest.mark.parametrize(
+    ("content", "expected"),
+    [
+        ('[project]\nversion = "1.2.3"', "1.2.3"),
+        ('[project]  # metadata\n\nname = "x"\nversion = "2.0"\n', "2.0"),
+        ('[tool.example]\nversion = "9"\n[project]\nname = "x"\n', None),
+        ('[project.urls]\nversion = "9"\n', None),
+        ('version = "9"\n', None),
+    ],
+)
+def test_project_version_table_boundaries(
+    tmp_path: Path, content: str, expected: str | None
+) -> None:
+    pyproject = tmp_path / "pyproject.toml"
+    pyproject.write_text(content, encoding="utf-8")
+
+    assert _project_version(pyproject) == expected
+
+
 def test_distribution_validator_rejects_extensionless_payloads(tmp_path: Path) -> None:
     sdist = tmp_path / "sphinx_lightbox-0.5.0.tar.gz"
     wheel = tmp_path / "sphinx_lightbox-0.5.0-py3-none-any.whl"